@@ -0,0 +1,61 @@
+"""Бенчмарк памяти на представление взаимодействий.
+
+Запуск: python -m benchmarks.entity_memory --interactions 1000000
+
+Сравнивает обычный dataclass, Interaction со __slots__ и интернированием
+строк и колоночный InteractionBatch. tracemalloc учитывает и исходные
+строки: после построения остаётся только то, что удерживает представление.
+"""
+import argparse
+import gc
+import random
+import tracemalloc
+from dataclasses import dataclass
+from domain.entities import ACTIONS, Interaction, InteractionBatch
+
+
+@dataclass
+class PlainInteraction:
+    user_id: str
+    video_id: str
+    action: str
+
+
+def make_columns(n_interactions: int, n_users: int, n_videos: int, seed: int = 0):
+    # Строки собираются заново для каждой строки, как при разборе ответа БД или JSON
+    rng = random.Random(seed)
+    return (
+        [f"user_{rng.randint(1, n_users)}" for _ in range(n_interactions)],
+        [f"video_{rng.randrange(n_videos)}" for _ in range(n_interactions)],
+        ["".join(rng.choice(ACTIONS)) for _ in range(n_interactions)],
+    )
+
+
+def measure(name: str, build, n_interactions: int, seed: int, args):
+    gc.collect()
+    tracemalloc.start()
+    columns = make_columns(n_interactions, args.users, args.videos, seed)
+    result = build(*columns)
+    del columns
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    per_million = current / n_interactions * 1_000_000 / 2 ** 20
+    print(f"{name:>18}: {current / 2 ** 20:8.1f} MiB retained, {peak / 2 ** 20:8.1f} MiB peak, "
+          f"{per_million:8.1f} MiB per 1M interactions")
+    del result
+
+
+def main(args):
+    n = args.interactions
+    measure("plain dataclass", lambda u, v, a: [PlainInteraction(*row) for row in zip(u, v, a)], n, 0, args)
+    measure("slots + intern", lambda u, v, a: [Interaction(*row) for row in zip(u, v, a)], n, 0, args)
+    measure("InteractionBatch", InteractionBatch.from_columns, n, 0, args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--interactions", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--videos", type=int, default=10_000)
+    main(parser.parse_args())
@@ -0,0 +1,225 @@
+"""Заменители RabbitMQ и PostgreSQL в памяти для бенчмарков.
+
+InMemoryBroker повторяет ту часть интерфейса очереди aio_pika, которой
+пользуются потребители из interfaces.consumer (итератор, ack/nack/reject,
+prefetch), и одновременно принимает publish(interaction) как
+InteractionPublisher. При подтверждении сообщения фиксируется задержка от
+отправки до ack, то есть до применения взаимодействия к модели.
+
+Для нескольких процессов-шардов ShardedProcessPublisher раскладывает
+взаимодействия по multiprocessing.Queue шардов (как обменник шардов
+RabbitMQ), а pump в процессе шарда перекладывает их в его InMemoryBroker.
+"""
+import asyncio
+import collections
+import contextlib
+import json
+import multiprocessing
+import time
+from typing import List, Optional, Sequence, Union
+from domain.entities import Interaction, InteractionBatch
+from domain.sharding import shard_of
+
+
+class InMemoryMessage:
+    def __init__(self, broker: "InMemoryBroker", body: bytes, published_at: float):
+        self.broker = broker
+        self.body = body
+        self.published_at = published_at
+        self.delivery_tag = 0
+        self.processed = False
+
+    async def ack(self, multiple: bool = False):
+        await self.broker._settle(self, multiple, ack=True)
+
+    async def nack(self, multiple: bool = False, requeue: bool = True):
+        await self.broker._settle(self, multiple, ack=False, requeue=requeue)
+
+    async def reject(self, requeue: bool = False):
+        await self.broker._settle(self, False, ack=False, requeue=requeue)
+
+    @contextlib.asynccontextmanager
+    async def process(self, requeue: bool = False, ignore_processed: bool = False):
+        try:
+            yield self
+        except Exception:
+            if not (ignore_processed and self.processed):
+                await self.reject(requeue=requeue)
+            raise
+        else:
+            if not (ignore_processed and self.processed):
+                await self.ack()
+
+
+class _InMemoryQueueIterator:
+    """Итератор очереди с поведением aio_pika.QueueIterator при отмене.
+
+    Отмена __anext__ закрывает итератор (подписка снимается), следующий
+    __anext__ подписывается заново, а повторное закрытие падает с KeyError
+    (close_callbacks.remove в aio-pika 9.4).
+    """
+
+    def __init__(self, broker: "InMemoryBroker"):
+        self.broker = broker
+        self._close_callbacks = {self.close}
+        self._subscribed = False
+
+    def _subscribe(self):
+        if not self._subscribed:
+            self._subscribed = True
+            self.broker.consumers += 1
+
+    async def close(self):
+        if not self._subscribed:
+            return
+        self._subscribed = False
+        self._close_callbacks.remove(self.close)
+        self.broker.consumers -= 1
+
+    async def __aenter__(self):
+        self._subscribe()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+        return False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> InMemoryMessage:
+        self._subscribe()
+        try:
+            return await self.broker._deliver()
+        except asyncio.CancelledError:
+            await self.close()
+            raise
+
+
+class InMemoryBroker:
+    """Одна очередь в памяти с prefetch и подтверждениями."""
+
+    def __init__(self, prefetch_count: int = 1):
+        self.prefetch_count = prefetch_count
+        self._ready = collections.deque()
+        self._unacked = collections.OrderedDict()
+        self._next_tag = 0
+        self._changed = asyncio.Condition()
+        self.published = 0
+        self.acked = 0
+        self.rejected = 0
+        self.consumers = 0
+        self.last_ack_at: Optional[float] = None
+        self.lags: List[float] = []
+
+    async def publish(self, interaction: Interaction):
+        await self.publish_body(json.dumps({
+            "user_id": interaction.user_id,
+            "video_id": interaction.video_id,
+            "action": interaction.action
+        }).encode())
+
+    async def publish_body(self, body: bytes):
+        async with self._changed:
+            self._ready.append(InMemoryMessage(self, body, time.perf_counter()))
+            self.published += 1
+            self._changed.notify_all()
+
+    async def queue_depth(self) -> int:
+        return len(self._ready) + len(self._unacked)
+
+    def iterator(self) -> _InMemoryQueueIterator:
+        return _InMemoryQueueIterator(self)
+
+    def __aiter__(self) -> _InMemoryQueueIterator:
+        return _InMemoryQueueIterator(self)
+
+    async def _deliver(self) -> InMemoryMessage:
+        async with self._changed:
+            await self._changed.wait_for(lambda: self._ready and len(self._unacked) < self.prefetch_count)
+            message = self._ready.popleft()
+            self._next_tag += 1
+            message.delivery_tag = self._next_tag
+            self._unacked[message.delivery_tag] = message
+            return message
+
+    async def _settle(self, message: InMemoryMessage, multiple: bool, ack: bool, requeue: bool = False):
+        async with self._changed:
+            if multiple:
+                tags = [tag for tag in self._unacked if tag <= message.delivery_tag]
+            else:
+                tags = [message.delivery_tag]
+            now = time.perf_counter()
+            requeued = []
+            for tag in tags:
+                settled = self._unacked.pop(tag)
+                settled.processed = True
+                if ack:
+                    self.acked += 1
+                    self.lags.append(now - settled.published_at)
+                elif requeue:
+                    settled.processed = False
+                    requeued.append(settled)
+                else:
+                    self.rejected += 1
+            if ack:
+                self.last_ack_at = now
+            self._ready.extendleft(reversed(requeued))
+            self._changed.notify_all()
+
+
+class ShardedProcessPublisher:
+    """Отправка взаимодействий в очереди процессов-шардов по shard_of(user_id)."""
+
+    def __init__(self, queues: Sequence[multiprocessing.Queue]):
+        self.queues = list(queues)
+        self.published = [0] * len(self.queues)
+
+    async def publish(self, interaction: Interaction):
+        shard = shard_of(interaction.user_id, len(self.queues))
+        self.queues[shard].put((interaction.user_id, interaction.video_id, interaction.action))
+        self.published[shard] += 1
+
+    def close(self):
+        for queue in self.queues:
+            queue.put(None)
+
+
+async def pump(source: multiprocessing.Queue, broker: InMemoryBroker, max_items: int = 1000):
+    """Перекладывание взаимодействий из межпроцессной очереди в брокер шарда; None - конец."""
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await loop.run_in_executor(None, source.get)]
+        # Остаток очереди забирается без переключения на пул потоков
+        while items[-1] is not None and len(items) < max_items and not source.empty():
+            items.append(source.get())
+        for item in items:
+            if item is None:
+                return
+            await broker.publish(Interaction(user_id=item[0], video_id=item[1], action=item[2]))
+
+
+class InMemoryInteractionRepository:
+    """Заменитель InteractionRepository; latency имитирует время ответа БД."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.interactions: List[Interaction] = []
+
+    async def _round_trip(self):
+        await asyncio.sleep(self.latency)
+
+    async def save_interaction(self, interaction: Interaction):
+        await self._round_trip()
+        self.interactions.append(interaction)
+
+    async def save_interactions(self, interactions: Union[List[Interaction], InteractionBatch]):
+        await self._round_trip()
+        self.interactions.extend(interactions)
+
+    async def get_interaction_watermark(self) -> int:
+        return len(self.interactions)
+
+    async def get_interactions_since(self, watermark: int):
+        delta = self.interactions[watermark:]
+        return InteractionBatch.from_interactions(delta), watermark + len(delta)
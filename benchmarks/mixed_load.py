@@ -0,0 +1,109 @@
+"""Бенчмарк задержки чтений при параллельных обновлениях модели.
+
+Запуск: python -m benchmarks.mixed_load --videos 3000 --duration 10
+
+Сравнивает выполнение в event loop (inline) и через пулы (pool): читатели
+вызывают recommend так же, как обработчик API, а писатель параллельно
+применяет взаимодействия и периодически перестраивает матрицы.
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+import numpy as np
+from domain.entities import Interaction, Video
+from domain.use_cases import Recommender, build_video_similarity
+from infrastructure.executor import PooledRecommenderExecutor, RecommenderExecutor
+
+ACTIONS = ["view", "like", "comment", "favorite"]
+ACTION_WEIGHTS = {"view": 1.0, "like": 2.0, "comment": 3.0, "favorite": 4.0}
+GENRES = [f"genre_{i}" for i in range(30)]
+
+
+def make_data(n_videos: int, n_users: int, n_interactions: int, seed: int = 0):
+    rng = random.Random(seed)
+    videos = [Video(id=f"video_{i}", genres=rng.sample(GENRES, rng.randint(1, 4))) for i in range(n_videos)]
+    interactions = [
+        Interaction(
+            user_id=f"user_{rng.randint(1, n_users)}",
+            video_id=f"video_{rng.randrange(n_videos)}",
+            action=rng.choice(ACTIONS)
+        )
+        for _ in range(n_interactions)
+    ]
+    return videos, interactions
+
+
+async def request(executor: RecommenderExecutor, recommender: Recommender, user_id: str, arrived: float, latencies):
+    await executor.read(recommender.recommend, user_id)
+    latencies.append(time.perf_counter() - arrived)
+
+
+async def readers(executor: RecommenderExecutor, recommender: Recommender, users, stop: float, rps: float, latencies):
+    """Открытая модель нагрузки: задержка считается от момента прихода запроса.
+
+    Запросы приходят с заданной частотой независимо от ответов, поэтому
+    остановка event loop попадает в результаты.
+    """
+    tasks = []
+    arrival = time.perf_counter()
+    while arrival < stop:
+        arrival += random.expovariate(rps)
+        await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+        tasks.append(asyncio.create_task(request(executor, recommender, random.choice(users), arrival, latencies)))
+    await asyncio.gather(*tasks)
+
+
+async def writer(executor: RecommenderExecutor, recommender: Recommender, videos, interactions, stop: float,
+                 rebuild_every: float):
+    next_rebuild = time.perf_counter() + rebuild_every
+    while time.perf_counter() < stop:
+        await executor.write(recommender.apply_interactions, random.sample(interactions, 100))
+        if time.perf_counter() >= next_rebuild:
+            similarity = await executor.rebuild(build_video_similarity, videos, recommender.similarity_mode,
+                                                recommender.top_k)
+            await executor.write(recommender.install_similarity, similarity)
+            await executor.write(recommender.update_user_item_matrix, interactions)
+            next_rebuild = time.perf_counter() + rebuild_every
+        await asyncio.sleep(0.01)
+
+
+async def run_mode(name: str, executor: RecommenderExecutor, args, videos, interactions):
+    recommender = Recommender(videos, ACTION_WEIGHTS, similarity_mode=args.mode, top_k=args.top_k)
+    recommender.compute_video_similarity()
+    recommender.update_user_item_matrix(interactions)
+    users = recommender.user_item_matrix.user_ids
+    latencies = []
+    stop = time.perf_counter() + args.duration
+    await asyncio.gather(
+        writer(executor, recommender, videos, interactions, stop, args.rebuild_every),
+        readers(executor, recommender, users, stop, args.rps, latencies)
+    )
+    executor.shutdown()
+    ms = np.array(latencies) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    print(f"{name:>7}: requests {len(ms):7d}, p50 {p50:8.2f} ms, p95 {p95:8.2f} ms, "
+          f"p99 {p99:8.2f} ms, max {ms.max():8.2f} ms")
+
+
+async def main(args):
+    videos, interactions = make_data(args.videos, args.users, args.interactions)
+    await run_mode("inline", RecommenderExecutor(), args, videos, interactions)
+    await run_mode("pool", PooledRecommenderExecutor(read_workers=args.read_workers), args, videos, interactions)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--videos", type=int, default=3000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--interactions", type=int, default=100000)
+    parser.add_argument("--rps", type=float, default=200.0, help="Частота запросов на чтение")
+    parser.add_argument("--read-workers", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--rebuild-every", type=float, default=2.0)
+    parser.add_argument("--mode", choices=["dense", "topk"], default="dense")
+    parser.add_argument("--top-k", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
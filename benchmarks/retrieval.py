@@ -0,0 +1,140 @@
+"""Офлайн-сравнение точной оценки по схожести и отбора кандидатов по эмбеддингам.
+
+    python -m benchmarks.retrieval --videos 20000 --users 20000 --nprobe 1,4,8,16,0
+
+Данные синтетические, но со структурой: у каждого пользователя есть
+любимые жанры, и большая часть его взаимодействий приходится на видео
+этих жанров (внутри жанра - по закону Зипфа). Для каждого пользователя
+последние --holdout видео откладываются, модель строится по остальным.
+
+Для каждого пути выводятся recall@N по отложенным видео, полнота IVF
+относительно точного перебора тех же векторов (для путей с эмбеддингами)
+и задержка Recommender.recommend. nprobe 0 - перебор всех ячеек.
+"""
+import argparse
+import logging
+import random
+import time
+from typing import Dict, List, Set, Tuple
+import numpy as np
+from benchmarks.load import ACTION_WEIGHTS, report
+from domain.embeddings import build_embedding_index
+from domain.entities import ACTIONS, Interaction, Video
+from domain.use_cases import Recommender
+from send_interactions import zipf_weights
+
+
+def generate(args) -> Tuple[List[Video], List[Interaction], Dict[str, Set[str]]]:
+    """Видео, обучающие взаимодействия и отложенные видео каждого пользователя."""
+    rng = np.random.default_rng(args.seed)
+    genres = [f"genre_{i}" for i in range(args.genres)]
+    video_genres = [rng.choice(args.genres, size=rng.integers(1, 4), replace=False) for _ in range(args.videos)]
+    videos = [Video(id=f"video_{i}", genres=[genres[g] for g in gs]) for i, gs in enumerate(video_genres)]
+    by_genre: List[List[int]] = [[] for _ in genres]
+    for i, gs in enumerate(video_genres):
+        for g in gs:
+            by_genre[g].append(i)
+    genre_p = [zipf_weights(len(members), args.video_zipf) for members in by_genre]
+    global_p = zipf_weights(args.videos, args.video_zipf)
+
+    train: List[Interaction] = []
+    holdout: Dict[str, Set[str]] = {}
+    for u in range(args.users):
+        user_id = f"user_{u}"
+        favourite = rng.choice(args.genres, size=rng.integers(1, 3), replace=False)
+        count = max(args.holdout + 2, int(rng.geometric(1 / args.interactions_per_user)))
+        watched: List[int] = []
+        for _ in range(count):
+            if rng.random() < args.taste:
+                g = favourite[rng.integers(len(favourite))]
+                watched.append(by_genre[g][rng.choice(len(by_genre[g]), p=genre_p[g])])
+            else:
+                watched.append(int(rng.choice(args.videos, p=global_p)))
+        unique = list(dict.fromkeys(watched))
+        held = set(unique[-args.holdout:]) if len(unique) > args.holdout else set()
+        holdout[user_id] = {f"video_{i}" for i in held}
+        for i in watched:
+            if i not in held:
+                train.append(Interaction(user_id=user_id, video_id=f"video_{i}",
+                                         action=ACTIONS[rng.integers(len(ACTIONS))]))
+    return videos, train, holdout
+
+
+def evaluate(name: str, recommender: Recommender, users: List[str], holdout: Dict[str, Set[str]], n: int,
+             exact_index=None):
+    """recall@n по отложенным видео, полнота IVF и задержка recommend."""
+    hits = total = 0
+    latencies = []
+    ann_hits = ann_total = 0
+    for user_id in users:
+        started = time.perf_counter()
+        recommended = recommender.recommend(user_id, n)
+        latencies.append(time.perf_counter() - started)
+        held = holdout[user_id]
+        hits += len(held & {vid for vid, _ in recommended})
+        total += len(held)
+        if exact_index is not None:
+            seen, ratings = recommender.user_item_matrix.row(user_id)
+            query = exact_index.user_vector(seen, ratings)
+            depth = n * recommender.rerank_depth
+            approximate, _ = exact_index.search(query, depth, nprobe=recommender.ann_nprobe, exclude=seen)
+            exact, _ = exact_index.search(query, depth, nprobe=exact_index.nlist, exclude=seen)
+            ann_hits += len(set(approximate.tolist()) & set(exact.tolist()))
+            ann_total += len(exact)
+    ann = f", IVF recall {ann_hits / ann_total:.3f}" if ann_total else ""
+    report(name, latencies, f"recall@{n} {hits / max(total, 1):.3f}{ann}")
+
+
+def main(args):
+    started = time.perf_counter()
+    videos, train, holdout = generate(args)
+    print(f"Generated {len(videos)} videos, {len(holdout)} users, {len(train)} training interactions "
+          f"in {time.perf_counter() - started:.1f} s")
+    recommender = Recommender(videos, ACTION_WEIGHTS, similarity_mode=args.mode, top_k=args.top_k,
+                              rerank_depth=args.rerank_depth)
+    recommender.compute_video_similarity()
+    recommender.update_user_item_matrix(train)
+    users = [u for u, held in holdout.items() if held and u in recommender.user_item_matrix]
+    users = random.Random(args.seed).sample(users, min(args.eval_users, len(users)))
+
+    started = time.perf_counter()
+    index = build_embedding_index(recommender.user_item_matrix.to_csr(), factors=args.factors, method=args.method,
+                                  nlist=args.nlist, iterations=args.iterations, seed=args.seed)
+    print(f"Trained {args.method} embeddings ({args.factors} factors, {index.nlist} IVF lists) "
+          f"in {time.perf_counter() - started:.1f} s, index memory {index.memory_usage() / 2**20:.1f} MiB")
+
+    evaluate(f"exact {args.mode}", recommender, users, holdout, args.n)
+    recommender.install_embeddings(index)
+    nprobes = [int(p) or index.nlist for p in args.nprobe.split(",")]
+    for weight in (0.0, args.rerank_weight):
+        recommender.rerank_weight = weight
+        for nprobe in nprobes:
+            recommender.ann_nprobe = nprobe
+            label = f"ann p{nprobe}" + (f" rr{weight:g}" if weight else "")
+            evaluate(label, recommender, users, holdout, args.n, exact_index=index)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger().setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--videos", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--genres", type=int, default=50)
+    parser.add_argument("--interactions-per-user", type=float, default=30.0)
+    parser.add_argument("--taste", type=float, default=0.8, help="Доля взаимодействий с любимыми жанрами")
+    parser.add_argument("--video-zipf", type=float, default=0.8)
+    parser.add_argument("--holdout", type=int, default=2)
+    parser.add_argument("--eval-users", type=int, default=1000)
+    parser.add_argument("--n", type=int, default=10)
+    parser.add_argument("--mode", choices=["dense", "topk"], default="topk")
+    parser.add_argument("--top-k", type=int, default=50)
+    parser.add_argument("--factors", type=int, default=64)
+    parser.add_argument("--method", choices=["als", "svd"], default="als")
+    parser.add_argument("--iterations", type=int, default=8)
+    parser.add_argument("--nlist", type=int, default=0, help="0 - около sqrt(videos)")
+    parser.add_argument("--nprobe", default="1,4,8,16,0", help="Значения nprobe через запятую, 0 - все ячейки")
+    parser.add_argument("--rerank-weight", type=float, default=0.3)
+    parser.add_argument("--rerank-depth", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,214 @@
+"""Локальная проверка шардированного режима: N процессов-шардов и маршрутизатор API.
+
+    python -m benchmarks.sharded --shards 4 --rate 0 --duration 10
+
+Модель строится один раз и экспортируется в артефакт; каждый процесс-шард
+открывает его через memmap (схожесть видео разделяется между процессами),
+оставляет своих пользователей, потребляет свою очередь взаимодействий и
+обслуживает API на своём порту. Родительский процесс публикует поток
+взаимодействий через ShardedProcessPublisher, читает рекомендации через
+interfaces.router и в конце сверяет ответы шардов с одним процессом,
+применившим все те же взаимодействия. RabbitMQ и PostgreSQL не нужны;
+нужен httpx.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import random
+import socket
+import tempfile
+import time
+from typing import List
+import numpy as np
+from benchmarks.in_memory import InMemoryBroker, InMemoryInteractionRepository, ShardedProcessPublisher, pump
+from benchmarks.load import ACTION_WEIGHTS, GENRES, readers, report, stop_task
+from domain.entities import Interaction, Video
+from domain.sharding import shard_of
+from domain.use_cases import Recommender
+from infrastructure.artifact import load_model_artifact, save_model_artifact
+from send_interactions import InteractionGenerator, publish_at_rate
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def run_shard(shard: int, shards: int, artifact_dir: str, source: multiprocessing.Queue, acked, port: int,
+              batch_size: int, linger_ms: float):
+    """Процесс-шард: артефакт, потребитель своей очереди и API (как main.py с SHARD_INDEX)."""
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger().setLevel(logging.ERROR)
+    asyncio.run(_shard_main(shard, shards, artifact_dir, source, acked, port, batch_size, linger_ms))
+
+
+async def _shard_main(shard: int, shards: int, artifact_dir: str, source: multiprocessing.Queue, acked, port: int,
+                      batch_size: int, linger_ms: float):
+    from uvicorn import Config, Server
+    from infrastructure.executor import PooledRecommenderExecutor
+    from interfaces.api import app
+    from interfaces.consumer import consume_interaction_batches
+
+    recommender, _ = load_model_artifact(artifact_dir, ACTION_WEIGHTS)
+    recommender.retain_users(lambda user_id: shard_of(user_id, shards) == shard)
+    executor = PooledRecommenderExecutor(read_workers=2, use_processes=False)
+    app.state.recommender = recommender
+    app.state.executor = executor
+
+    broker = InMemoryBroker(prefetch_count=batch_size)
+    consumer = asyncio.create_task(consume_interaction_batches(
+        broker, recommender, InMemoryInteractionRepository(), batch_size, linger_ms, executor=executor
+    ))
+    server = Server(Config(app=app, host="127.0.0.1", port=port, log_level="error"))
+    serving = asyncio.create_task(server.serve())
+
+    async def report_acked():
+        while True:
+            acked[shard] = broker.acked
+            await asyncio.sleep(0.02)
+
+    reporter = asyncio.create_task(report_acked())
+    await pump(source, broker)
+    # Очередь закрыта: дожидаемся применения всего принятого и останавливаемся
+    while await broker.queue_depth():
+        await asyncio.sleep(0.02)
+    acked[shard] = broker.acked
+    server.should_exit = True
+    await serving
+    for task in (consumer, reporter):
+        await stop_task(task)
+    executor.shutdown()
+
+
+async def wait_ready(client, urls: List[str], timeout: float = 60.0):
+    deadline = time.perf_counter() + timeout
+    for url in urls:
+        while True:
+            try:
+                if (await client.get(f"{url}/popular")).status_code in (200, 404):
+                    break
+            except Exception:
+                pass
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"Shard {url} did not start")
+            await asyncio.sleep(0.2)
+
+
+async def run(args):
+    import httpx
+    from interfaces.router import ShardRouter, router_app
+
+    rng = random.Random(args.seed)
+    videos = [Video(id=f"video_{i}", genres=rng.sample(GENRES, rng.randint(1, 4))) for i in range(args.videos)]
+    generate = InteractionGenerator([v.id for v in videos], args.users, args.user_zipf, args.video_zipf,
+                                    seed=args.seed)
+    model = Recommender(videos, ACTION_WEIGHTS, similarity_mode=args.mode, top_k=args.top_k)
+    model.compute_video_similarity()
+    model.update_user_item_matrix(generate.batch(args.warm_interactions))
+    artifact_dir = tempfile.mkdtemp(prefix="sharded-")
+    save_model_artifact(model, artifact_dir, 0)
+    del model
+
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue() for _ in range(args.shards)]
+    acked = context.Array("q", args.shards)
+    ports = [free_port() for _ in range(args.shards)]
+    processes = [
+        context.Process(target=run_shard, args=(shard, args.shards, artifact_dir, queues[shard], acked, ports[shard],
+                                                args.batch_size, args.linger_ms), daemon=True)
+        for shard in range(args.shards)
+    ]
+    for process in processes:
+        process.start()
+    urls = [f"http://127.0.0.1:{port}" for port in ports]
+    publisher = ShardedProcessPublisher(queues)
+    sent: List[Interaction] = []
+
+    def generate_and_record() -> Interaction:
+        interaction = generate()
+        sent.append(interaction)
+        return interaction
+
+    limits = httpx.Limits(max_connections=args.http_connections)
+    try:
+        async with httpx.AsyncClient(timeout=10.0, limits=limits) as upstream:
+            await wait_ready(upstream, urls)
+            router_app.state.shard_router = ShardRouter(urls, upstream)
+            transport = httpx.ASGITransport(app=router_app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://router", timeout=10.0) as client:
+                async def fetch(user_id: str):
+                    response = await client.get(f"/recommendations/{user_id}")
+                    if response.status_code not in (200, 404):
+                        response.raise_for_status()
+
+                latencies, errors = [], []
+                started = time.perf_counter()
+                stop = started + args.duration
+                stats, _ = await asyncio.gather(
+                    publish_at_rate(publisher, generate_and_record, args.rate, duration=args.duration,
+                                    max_in_flight=args.max_in_flight),
+                    readers(fetch, generate, stop, args.rps, latencies, errors)
+                )
+                deadline = time.perf_counter() + args.drain_timeout
+                while sum(acked) < stats.sent and time.perf_counter() < deadline:
+                    await asyncio.sleep(0.02)
+                consumed_in = time.perf_counter() - started
+
+                # Сверка с одним процессом, применившим те же взаимодействия
+                reference, _ = load_model_artifact(artifact_dir, ACTION_WEIGHTS)
+                reference.apply_interactions(sent)
+                check_users = list(dict.fromkeys(i.user_id for i in reversed(sent)))[:args.check_users]
+                mismatched = []
+                for user_id in check_users:
+                    response = await client.get(f"/recommendations/{user_id}")
+                    if response.status_code not in (200, 404):
+                        mismatched.append(f"{user_id} (HTTP {response.status_code})")
+                        continue
+                    # 404 - пустые рекомендации: сравнивается с пустым списком эталона
+                    got = []
+                    if response.status_code == 200:
+                        got = [(item["video_id"], item["score"]) for item in response.json()]
+                    expected = reference.recommend(user_id)
+                    if [v for v, _ in got] != [v for v, _ in expected] or not np.allclose(
+                            [s for _, s in got], [s for _, s in expected], atol=1e-6):
+                        mismatched.append(user_id)
+    finally:
+        publisher.close()
+        for process in processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+
+    print(f"{'published':>12}: {stats.sent} msgs in {stats.elapsed:.2f} s, {stats.rate:.0f} msgs/sec")
+    print(f"{'consumed':>12}: {sum(acked)} msgs in {consumed_in:.2f} s, {sum(acked) / consumed_in:.0f} msgs/sec, "
+          f"per shard {list(acked)}")
+    report("api reads", latencies, f"errors {len(errors)}")
+    print(f"{'consistency':>12}: {len(check_users) - len(mismatched)}/{len(check_users)} users match "
+          f"a single process" + (f", mismatched e.g. {mismatched[:3]}" if mismatched else ""))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    logging.getLogger().setLevel(logging.ERROR)
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=0.0, help="Сообщений в секунду, 0 - без ограничения")
+    parser.add_argument("--rps", type=float, default=200.0, help="Частота запросов на чтение через маршрутизатор")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--drain-timeout", type=float, default=60.0)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--user-zipf", type=float, default=1.1)
+    parser.add_argument("--video-zipf", type=float, default=1.1)
+    parser.add_argument("--max-in-flight", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--videos", type=int, default=3000)
+    parser.add_argument("--warm-interactions", type=int, default=100000)
+    parser.add_argument("--mode", choices=["dense", "topk"], default="topk")
+    parser.add_argument("--top-k", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--linger-ms", type=float, default=50.0)
+    parser.add_argument("--http-connections", type=int, default=64)
+    parser.add_argument("--check-users", type=int, default=200)
+    asyncio.run(run(parser.parse_args()))
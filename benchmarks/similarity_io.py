@@ -0,0 +1,67 @@
+"""Бенчмарк сохранения и загрузки матрицы схожести через COPY.
+
+Запуск: python -m benchmarks.similarity_io --videos 3000
+
+Работает на отдельном соединении с временной таблицей video_similarity,
+которая перекрывает основную, поэтому реальные данные не затрагиваются.
+"""
+import argparse
+import asyncio
+import logging
+import time
+import asyncpg
+import numpy as np
+from config import host, user, password, db_name
+from infrastructure.db import VideoRepository
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
+
+async def run(n_videos: int, density: float):
+    pool = await asyncpg.create_pool(
+        user=user,
+        password=password,
+        database=db_name,
+        host=host,
+        min_size=1,
+        max_size=1,
+        init=lambda conn: conn.execute(
+            "CREATE TEMP TABLE video_similarity (LIKE public.video_similarity INCLUDING DEFAULTS)"
+        )
+    )
+    try:
+        repo = VideoRepository(pool)
+        rng = np.random.default_rng(0)
+        video_ids = np.array([f"video_{i}" for i in range(n_videos)], dtype=object)
+        rows, cols = np.triu_indices(n_videos)
+        keep = rng.random(len(rows)) < density
+        rows, cols = rows[keep], cols[keep]
+        similarity = rng.random(len(rows))
+
+        start = time.perf_counter()
+        await repo.save_similarity_pairs(video_ids[rows], video_ids[cols], similarity)
+        save_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        v1, _, _ = await repo.get_similarity_pairs()
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await repo.get_similarity_matrix()
+        matrix_time = time.perf_counter() - start
+
+        print(f"videos: {n_videos}, pairs: {len(similarity)}")
+        print(f"save (COPY to table):   {save_time:8.3f} s, {len(similarity) / save_time:12.0f} rows/sec")
+        print(f"load (COPY from query): {load_time:8.3f} s, {len(v1) / load_time:12.0f} rows/sec")
+        print(f"load + dense assembly:  {matrix_time:8.3f} s, {len(v1) / matrix_time:12.0f} rows/sec")
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--videos", type=int, default=3000)
+    parser.add_argument("--density", type=float, default=1.0, help="Доля сохраняемых пар верхнего треугольника")
+    args = parser.parse_args()
+    asyncio.run(run(args.videos, args.density))
@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class RecommendationCache:
+    """LRU-кэш готовых рекомендаций с ограничением по времени жизни.
+
+    Ключ - (user_id, n). Записи пользователя сбрасываются при применении его
+    взаимодействий, весь кэш - при замене модели схожести. Чтобы результат,
+    посчитанный параллельно с обновлением, не попал в кэш, put принимает
+    token (значение generation до начала расчёта) и отбрасывает устаревшее.
+    """
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 300.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._entries: "OrderedDict[Tuple[Hashable, int], Tuple[float, List[Tuple[str, float]]]]" = OrderedDict()
+        self._keys_by_user: Dict[Hashable, Set[int]] = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._floor = 0
+        self._invalidated: "OrderedDict[Hashable, int]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, user_id: Hashable, n: int) -> Optional[List[Tuple[str, float]]]:
+        key = (user_id, n)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, user_id: Hashable, n: int, value: List[Tuple[str, float]], token: Optional[int] = None):
+        key = (user_id, n)
+        with self._lock:
+            if token is not None and (token < self._floor or token < self._invalidated.get(user_id, -1)):
+                return
+            self._entries[key] = (self._clock() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            self._keys_by_user.setdefault(user_id, set()).add(n)
+            while len(self._entries) > self.max_entries:
+                oldest, _ = next(iter(self._entries.items()))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def invalidate_user(self, user_id: Hashable):
+        """Сброс всех записей пользователя."""
+        with self._lock:
+            self._generation += 1
+            self._invalidated[user_id] = self._generation
+            self._invalidated.move_to_end(user_id)
+            if len(self._invalidated) > self.max_entries:
+                _, generation = self._invalidated.popitem(last=False)
+                self._floor = max(self._floor, generation)
+            for n in self._keys_by_user.pop(user_id, ()):
+                if self._entries.pop((user_id, n), None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        """Сброс всего кэша (например, при замене модели схожести)."""
+        with self._lock:
+            self._generation += 1
+            self._floor = self._generation
+            self._invalidated.clear()
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._keys_by_user.clear()
+        logger.debug("Recommendation cache cleared")
+
+    def _remove(self, key: Tuple[Hashable, int]):
+        self._entries.pop(key, None)
+        user_id, n = key
+        keys = self._keys_by_user.get(user_id)
+        if keys is not None:
+            keys.discard(n)
+            if not keys:
+                del self._keys_by_user[user_id]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
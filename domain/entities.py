@@ -1,13 +1,102 @@
+import sys
+import numpy as np
 from dataclasses import dataclass
-from typing import List
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+ACTIONS = ("view", "like", "comment", "favorite")
+ACTION_CODES = {action: code for code, action in enumerate(ACTIONS)}
+UNKNOWN_ACTION = 255
+
+def _encode_actions(actions: Sequence[str]) -> Tuple[np.ndarray, Dict[int, str]]:
+    """uint8-коды действий и исходные строки тех, что не входят в ACTIONS."""
+    codes = np.fromiter((ACTION_CODES.get(a, UNKNOWN_ACTION) for a in actions), dtype=np.uint8, count=len(actions))
+    unknown = {i: sys.intern(actions[i]) for i in np.flatnonzero(codes == UNKNOWN_ACTION).tolist()}
+    return codes, unknown
 
 @dataclass
 class Video:
+    __slots__ = ("id", "genres")
     id: str
     genres: List[str]
 
+    def __post_init__(self):
+        self.id = sys.intern(self.id)
+
 @dataclass
 class Interaction:
+    __slots__ = ("user_id", "video_id", "action")
     user_id: str
     video_id: str
-    action: str
\ No newline at end of file
+    action: str
+
+    def __post_init__(self):
+        # Идентификаторы повторяются миллионы раз - храним по одной копии строки
+        self.user_id = sys.intern(self.user_id)
+        self.video_id = sys.intern(self.video_id)
+        self.action = sys.intern(self.action)
+
+    @property
+    def action_code(self) -> int:
+        return ACTION_CODES.get(self.action, UNKNOWN_ACTION)
+
+@dataclass
+class InteractionBatch:
+    """Колоночное представление пачки взаимодействий.
+
+    user_ids и video_ids - массивы интернированных строк, action_codes -
+    uint8-коды действий из ACTIONS (UNKNOWN_ACTION для прочих). Исходные
+    строки прочих действий хранятся в unknown_actions по номеру в пачке:
+    они редки, а терять их при сохранении в БД нельзя.
+    """
+    __slots__ = ("user_ids", "video_ids", "action_codes", "unknown_actions")
+    user_ids: np.ndarray
+    video_ids: np.ndarray
+    action_codes: np.ndarray
+    unknown_actions: Dict[int, str]
+
+    @classmethod
+    def from_columns(cls, user_ids: Sequence[str], video_ids: Sequence[str],
+                     actions: Sequence[str]) -> "InteractionBatch":
+        intern = sys.intern
+        action_codes, unknown_actions = _encode_actions(actions)
+        return cls(
+            user_ids=np.array([intern(u) for u in user_ids], dtype=object),
+            video_ids=np.array([intern(v) for v in video_ids], dtype=object),
+            action_codes=action_codes,
+            unknown_actions=unknown_actions
+        )
+
+    @classmethod
+    def from_interactions(cls, interactions: Iterable[Interaction]) -> "InteractionBatch":
+        interactions = list(interactions)
+        action_codes, unknown_actions = _encode_actions([i.action for i in interactions])
+        return cls(
+            user_ids=np.array([i.user_id for i in interactions], dtype=object),
+            video_ids=np.array([i.video_id for i in interactions], dtype=object),
+            action_codes=action_codes,
+            unknown_actions=unknown_actions
+        )
+
+    @property
+    def actions(self) -> List[str]:
+        actions = [ACTIONS[c] if c < len(ACTIONS) else "" for c in self.action_codes.tolist()]
+        for i, action in self.unknown_actions.items():
+            actions[i] = action
+        return actions
+
+    def take(self, mask: np.ndarray) -> "InteractionBatch":
+        """Пачка из взаимодействий, отмеченных в mask."""
+        unknown_actions = {}
+        if self.unknown_actions:
+            kept = np.arange(len(self))[mask].tolist()
+            unknown_actions = {new: self.unknown_actions[old] for new, old in enumerate(kept)
+                               if old in self.unknown_actions}
+        return InteractionBatch(user_ids=self.user_ids[mask], video_ids=self.video_ids[mask],
+                                action_codes=self.action_codes[mask], unknown_actions=unknown_actions)
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def __iter__(self) -> Iterator[Interaction]:
+        for user_id, video_id, action in zip(self.user_ids, self.video_ids, self.actions):
+            yield Interaction(user_id=user_id, video_id=video_id, action=action)
@@ -0,0 +1,226 @@
+import logging
+import math
+import threading
+import time
+import numpy as np
+from typing import Callable, Collection, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def _top_order(scores: np.ndarray, m: int) -> np.ndarray:
+    """Позиции m наибольших scores по убыванию."""
+    top = np.argpartition(-scores, m - 1)[:m] if m < len(scores) else np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+class PopularityRanking:
+    """Неизменяемый рейтинг популярных видео: общий и по жанрам.
+
+    Списки отсортированы по убыванию популярности, поэтому top(n) проходит
+    только первые n элементов (плюс пропущенные из exclude). Списки обрезаны
+    до max_ranked видео; если exclude выбил из них слишком много, top ищет
+    по оценкам всего каталога (catalog_ids, catalog_scores, genre_cols).
+    """
+    __slots__ = ("video_ids", "scores", "by_genre", "catalog_ids", "catalog_scores", "genre_cols")
+
+    def __init__(self, video_ids: List[str], scores: List[float],
+                 by_genre: Optional[Dict[str, Tuple[List[str], List[float]]]] = None,
+                 catalog_ids: Optional[List[str]] = None, catalog_scores: Optional[np.ndarray] = None,
+                 genre_cols: Optional[Dict[str, np.ndarray]] = None):
+        self.video_ids = video_ids
+        self.scores = scores
+        self.by_genre = by_genre or {}
+        self.catalog_ids = catalog_ids if catalog_ids is not None else video_ids
+        self.catalog_scores = catalog_scores if catalog_scores is not None else np.asarray(scores, dtype=np.float64)
+        self.genre_cols = genre_cols or {}
+
+    def top(self, n: int, genre: Optional[str] = None,
+            exclude: Optional[Collection[str]] = None) -> List[Tuple[str, float]]:
+        if genre is None:
+            video_ids, scores = self.video_ids, self.scores
+        else:
+            video_ids, scores = self.by_genre.get(genre, ([], []))
+        result = []
+        for video_id, score in zip(video_ids, scores):
+            if len(result) >= n:
+                break
+            if exclude and video_id in exclude:
+                continue
+            result.append((video_id, score))
+        if len(result) < n and exclude:
+            cols = self._columns(genre)
+            if len(video_ids) < len(cols):
+                return self._top_catalog(n, cols, exclude)
+        return result
+
+    def _columns(self, genre: Optional[str]) -> np.ndarray:
+        if genre is None:
+            return np.arange(len(self.catalog_ids))
+        return self.genre_cols.get(genre, np.empty(0, dtype=np.int64))
+
+    def _top_catalog(self, n: int, cols: np.ndarray, exclude: Collection[str]) -> List[Tuple[str, float]]:
+        """top по всем видео cols, а не по обрезанному списку."""
+        catalog_ids = self.catalog_ids
+        keep = np.fromiter((catalog_ids[c] not in exclude for c in cols.tolist()), dtype=bool, count=len(cols))
+        cols = cols[keep]
+        m = min(n, len(cols))
+        if m <= 0:
+            return []
+        scores = self.catalog_scores[cols]
+        top = _top_order(scores, m)
+        return [(catalog_ids[c], score) for c, score in zip(cols[top].tolist(), scores[top].tolist())]
+
+
+class PopularityIndex:
+    """Популярность видео: взвешенные счётчики действий с экспоненциальным затуханием.
+
+    Вклад действия уменьшается вдвое каждые half_life секунд. Чтобы не
+    умножать все счётчики на каждом обновлении, новые вклады умножаются на
+    exp(λ(t - t0)): порядок видео от общего множителя не зависит, а когда
+    множитель становится большим, счётчики перенормируются.
+
+    Счётчики выровнены по столбцам матрицы пользователь-элемент и меняются
+    только писателем рекомендателя. Читатели получают PopularityRanking,
+    который пересчитывается не чаще раза в refresh_interval секунд (и сразу
+    после изменения каталога) и публикуется одним присваиванием. Если после
+    последнего пересчёта были действия, а новых нет, устаревший рейтинг
+    пересчитывает первый читатель, которому удалось без ожидания взять
+    блокировку индекса (иначе он отдаёт текущий рейтинг).
+    """
+
+    def __init__(self, video_ids: Sequence[str], genres: Sequence[Sequence[str]], half_life: float = 86400.0,
+                 refresh_interval: float = 1.0, max_ranked: int = 1000, clock: Callable[[], float] = time.time):
+        self.half_life = half_life
+        self.refresh_interval = refresh_interval
+        self.max_ranked = max_ranked
+        self._clock = clock
+        self._decay = math.log(2) / half_life
+        self._video_ids: List[str] = list(video_ids)
+        self._genres: List[List[str]] = [list(g or []) for g in genres]
+        self._scores = np.zeros(len(self._video_ids), dtype=np.float64)
+        self._genre_cols: Optional[Dict[str, np.ndarray]] = None
+        self._t0 = clock()
+        self._refreshed_at = -math.inf
+        self._ranking = PopularityRanking([], [])
+        # Изменения счётчиков и пересчёт рейтинга; читатели берут её только без ожидания
+        self._lock = threading.Lock()
+        self._stale = False
+        self.refresh()
+
+    @property
+    def ranking(self) -> PopularityRanking:
+        if (self._stale and self._clock() - self._refreshed_at >= self.refresh_interval
+                and self._lock.acquire(blocking=False)):
+            try:
+                if self._stale:
+                    self._refresh()
+            finally:
+                self._lock.release()
+        return self._ranking
+
+    def top(self, n: int, genre: Optional[str] = None,
+            exclude: Optional[Collection[str]] = None) -> List[Tuple[str, float]]:
+        return self.ranking.top(n, genre, exclude)
+
+    def _weight_factor(self, now: float) -> float:
+        factor = math.exp(self._decay * (now - self._t0))
+        if factor > 1e12:
+            self._scores /= factor
+            self._t0 = now
+            factor = 1.0
+        return factor
+
+    def decayed_scores(self) -> np.ndarray:
+        """Счётчики, приведённые к текущему моменту."""
+        return self._scores / math.exp(self._decay * (self._clock() - self._t0))
+
+    def seed(self, scores: np.ndarray, as_of: Optional[float] = None):
+        """Начальные счётчики (например, суммы столбцов матрицы пользователь-элемент).
+
+        as_of - момент, к которому приведены счётчики; без него они считаются текущими.
+        """
+        scores = np.asarray(scores, dtype=np.float64)
+        if scores.shape != self._scores.shape:
+            raise ValueError(f"Popularity seed has shape {scores.shape}, expected {self._scores.shape}")
+        with self._lock:
+            now = self._clock()
+            self._scores = scores.copy()
+            if as_of is not None and now > as_of:
+                self._scores *= math.exp(-self._decay * (now - as_of))
+            self._t0 = now
+            self._refresh()
+
+    def add(self, cols: np.ndarray, weights: np.ndarray):
+        """Учёт действий с видео cols (номера столбцов) с весами weights."""
+        if not len(cols):
+            return
+        with self._lock:
+            now = self._clock()
+            factor = self._weight_factor(now)
+            self._scores += np.bincount(cols, weights=np.asarray(weights, dtype=np.float64) * factor,
+                                        minlength=len(self._scores))
+            self._stale = True
+            if now - self._refreshed_at >= self.refresh_interval:
+                self._refresh()
+
+    def extend(self, video_ids: Sequence[str], genres: Sequence[Sequence[str]]):
+        """Добавление новых видео в конец (как столбцов в матрице пользователь-элемент)."""
+        with self._lock:
+            self._video_ids = self._video_ids + list(video_ids)
+            self._genres = self._genres + [list(g or []) for g in genres]
+            self._scores = np.concatenate([self._scores, np.zeros(len(video_ids), dtype=np.float64)])
+            self._genre_cols = None
+
+    def set_genres(self, cols: Sequence[int], genres: Sequence[Sequence[str]]):
+        with self._lock:
+            self._genres = list(self._genres)
+            for col, video_genres in zip(cols, genres):
+                self._genres[col] = list(video_genres or [])
+            self._genre_cols = None
+
+    def remove(self, cols: np.ndarray):
+        with self._lock:
+            keep = np.ones(len(self._video_ids), dtype=bool)
+            keep[cols] = False
+            self._video_ids = [vid for vid, kept in zip(self._video_ids, keep.tolist()) if kept]
+            self._genres = [g for g, kept in zip(self._genres, keep.tolist()) if kept]
+            self._scores = self._scores[keep]
+            self._genre_cols = None
+
+    def _columns_by_genre(self) -> Dict[str, np.ndarray]:
+        if self._genre_cols is None:
+            genre_cols: Dict[str, List[int]] = {}
+            for col, video_genres in enumerate(self._genres):
+                for genre in video_genres:
+                    genre_cols.setdefault(genre, []).append(col)
+            self._genre_cols = {genre: np.array(cols, dtype=np.int64) for genre, cols in genre_cols.items()}
+        return self._genre_cols
+
+    def _ranked(self, cols: np.ndarray, scores: np.ndarray, scale: float) -> Tuple[List[str], List[float]]:
+        m = min(self.max_ranked, len(cols))
+        if m == 0:
+            return [], []
+        top = _top_order(scores, m)
+        return [self._video_ids[c] for c in cols[top].tolist()], (scores[top] / scale).tolist()
+
+    def refresh(self):
+        """Пересчёт опубликованного рейтинга (общего и по жанрам)."""
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        started = time.perf_counter()
+        scores = self._scores
+        # Оценки нормируются на максимум, поэтому общий множитель затухания не важен
+        scale = float(scores.max()) if len(scores) and scores.max() > 0 else 1.0
+        video_ids, ranked_scores = self._ranked(np.arange(len(scores)), scores, scale)
+        genre_cols = self._columns_by_genre()
+        by_genre = {genre: self._ranked(cols, scores[cols], scale) for genre, cols in genre_cols.items()}
+        # Счётчики меняются на месте, а списки видео и жанров заменяются целиком - копируются только оценки
+        self._ranking = PopularityRanking(video_ids, ranked_scores, by_genre, catalog_ids=self._video_ids,
+                                          catalog_scores=scores / scale, genre_cols=genre_cols)
+        self._refreshed_at = self._clock()
+        self._stale = False
+        logger.debug("Refreshed popularity ranking: %d videos, %d genres in %.1f ms",
+                     len(scores), len(by_genre), (time.perf_counter() - started) * 1000)
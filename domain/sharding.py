@@ -0,0 +1,27 @@
+import zlib
+import numpy as np
+from typing import Dict, List, Sequence
+
+
+def shard_of(user_id: str, shards: int) -> int:
+    """Номер шарда пользователя.
+
+    crc32 не зависит от процесса (в отличие от hash() со случайной солью),
+    поэтому издатель, потребители и маршрутизатор API считают одинаково.
+    """
+    if shards <= 1:
+        return 0
+    return zlib.crc32(user_id.encode()) % shards
+
+
+def shard_mask(user_ids: Sequence[str], shard: int, shards: int) -> np.ndarray:
+    """Маска пользователей, принадлежащих шарду shard."""
+    return np.fromiter((shard_of(u, shards) == shard for u in user_ids), dtype=bool, count=len(user_ids))
+
+
+def partition(user_ids: Sequence[str], shards: int) -> Dict[int, List[str]]:
+    """Разбиение пользователей по шардам с сохранением порядка внутри шарда."""
+    parts: Dict[int, List[str]] = {}
+    for user_id in user_ids:
+        parts.setdefault(shard_of(user_id, shards), []).append(user_id)
+    return parts
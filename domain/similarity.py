@@ -0,0 +1,288 @@
+import logging
+import numpy as np
+import scipy.sparse as sp
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class GenreFeatures:
+    """Нормированные бинарные векторы жанров в порядке видео каталога.
+
+    Косинусная схожесть видео i и j равна matrix[i] @ matrix[j], поэтому
+    схожесть изменённых видео со всем каталогом считается одним умножением,
+    без повторного кодирования жанров всех видео. Новые жанры добавляются
+    столбцами и не меняют схожесть уже известных видео.
+    """
+
+    def __init__(self, classes: List[str], matrix: np.ndarray):
+        self.classes = classes
+        self.class_index: Dict[str, int] = {genre: i for i, genre in enumerate(classes)}
+        self.matrix = matrix
+
+    @classmethod
+    def from_genres(cls, genres: Sequence[Sequence[str]]) -> "GenreFeatures":
+        empty = cls([], np.zeros((0, 0), dtype=np.float64))
+        return empty.with_rows(np.arange(len(genres)), genres, len(genres))
+
+    def with_rows(self, rows: np.ndarray, genres: Sequence[Sequence[str]], n: int) -> "GenreFeatures":
+        """Новые векторы для n видео, в которых строки rows заданы жанрами genres."""
+        classes = list(self.classes)
+        class_index = dict(self.class_index)
+        for video_genres in genres:
+            for genre in video_genres or []:
+                if genre not in class_index:
+                    class_index[genre] = len(classes)
+                    classes.append(genre)
+        matrix = np.zeros((n, len(classes)), dtype=np.float64)
+        old_rows = min(n, self.matrix.shape[0])
+        matrix[:old_rows, :self.matrix.shape[1]] = self.matrix[:old_rows]
+        for row, video_genres in zip(np.asarray(rows).tolist(), genres):
+            matrix[row] = 0.0
+            cols = sorted({class_index[genre] for genre in video_genres or []})
+            if cols:
+                matrix[row, cols] = 1.0 / np.sqrt(len(cols))
+        return GenreFeatures(classes, matrix)
+
+    def without(self, rows: np.ndarray) -> "GenreFeatures":
+        return GenreFeatures(self.classes, np.delete(self.matrix, rows, axis=0))
+
+    def similarity(self, rows: np.ndarray, noise: float = 0.0,
+                   rng: Optional[np.random.Generator] = None) -> np.ndarray:
+        """Косинусная схожесть видео rows со всеми видео каталога (len(rows) x n)."""
+        block = self.matrix[rows] @ self.matrix.T
+        if noise:
+            block += (rng or np.random.default_rng()).normal(0, noise, block.shape)
+        return block
+
+
+def _top_k(block: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Индексы и значения k лучших элементов каждой строки, по убыванию."""
+    if k == 0:
+        return np.empty((block.shape[0], 0), dtype=np.int32), np.empty((block.shape[0], 0), dtype=np.float64)
+    top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+    top_values = np.take_along_axis(block, top, axis=1)
+    # Соседи внутри строки упорядочены по убыванию схожести
+    order = np.argsort(-top_values, axis=1, kind="stable")
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_values, order, axis=1)
+
+
+class TopKSimilarityIndex:
+    """Разреженный индекс соседей: для каждого видео хранятся K самых похожих.
+
+    Строка i CSR-матрицы neighbours содержит индексы соседей видео i и
+    значения схожести. Само видео в список своих соседей не входит.
+    """
+
+    def __init__(self, neighbours: sp.csr_matrix, k: int):
+        self.neighbours = neighbours
+        self.k = k
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.neighbours.shape
+
+    @classmethod
+    def from_features(cls, features: np.ndarray, k: int, block_size: int = 1024,
+                      noise: float = 0.0, rng: Optional[np.random.Generator] = None) -> "TopKSimilarityIndex":
+        """Построение индекса по матрице признаков (косинусная схожесть).
+
+        Схожесть считается блоками по block_size строк, поэтому пиковая память
+        ограничена block_size x N вместо N x N.
+        """
+        features = np.asarray(features, dtype=np.float64)
+        norms = np.linalg.norm(features, axis=1, keepdims=True)
+        normalized = np.divide(features, norms, out=np.zeros_like(features), where=norms > 0)
+        rng = rng or np.random.default_rng()
+
+        def block_similarity(start: int, end: int) -> np.ndarray:
+            block = normalized[start:end] @ normalized.T
+            if noise:
+                block += rng.normal(0, noise, block.shape)
+            return block
+
+        return cls._from_blocks(block_similarity, normalized.shape[0], k, block_size)
+
+    @classmethod
+    def from_dense(cls, similarity: np.ndarray, k: int, block_size: int = 1024) -> "TopKSimilarityIndex":
+        """Прореживание готовой плотной матрицы схожести до K соседей."""
+        similarity = np.asarray(similarity, dtype=np.float64)
+        return cls._from_blocks(lambda start, end: similarity[start:end].copy(),
+                                similarity.shape[0], k, block_size)
+
+    @classmethod
+    def from_pairs(cls, rows: np.ndarray, cols: np.ndarray, values: np.ndarray, n: int, k: int) -> "TopKSimilarityIndex":
+        """Построение индекса по разреженным парам (i, j, схожесть) без плотной матрицы."""
+        rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        off_diagonal = rows != cols
+        rows, cols, values = rows[off_diagonal], cols[off_diagonal], values[off_diagonal]
+        _, first = np.unique(rows * n + cols, return_index=True)
+        rows, cols, values = rows[first], cols[first], values[first]
+
+        order = np.lexsort((-values, rows))
+        rows, cols, values = rows[order], cols[order], values[order]
+        counts = np.bincount(rows, minlength=n)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        keep = np.arange(len(rows)) - starts[rows] < k
+        rows, cols, values = rows[keep], cols[keep], values[keep]
+
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+        neighbours = sp.csr_matrix((values, cols.astype(np.int32), indptr), shape=(n, n))
+        logger.info("Built top-%d similarity index for %d videos from %d pairs", k, n, len(first))
+        return cls(neighbours, k)
+
+    @classmethod
+    def _from_blocks(cls, block_similarity, n: int, k: int, block_size: int) -> "TopKSimilarityIndex":
+        k = max(0, min(k, n - 1))
+        indices = np.empty((n, k), dtype=np.int32)
+        data = np.empty((n, k), dtype=np.float64)
+        for start in range(0, n, block_size):
+            end = min(start + block_size, n)
+            block = block_similarity(start, end)
+            rows = np.arange(end - start)
+            block[rows, rows + start] = -np.inf
+            indices[start:end], data[start:end] = _top_k(block, k)
+        indptr = np.arange(0, n * k + 1, k, dtype=np.int64)
+        neighbours = sp.csr_matrix((data.ravel(), indices.ravel(), indptr), shape=(n, n))
+        logger.info("Built top-%d similarity index for %d videos, nnz: %d", k, n, neighbours.nnz)
+        return cls(neighbours, k)
+
+    def score(self, seen: np.ndarray, ratings: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Оценки кандидатов - соседей просмотренных видео.
+
+        Возвращает индексы кандидатов и сумму схожестей, взвешенных оценками
+        пользователя; остальные видео каталога не рассматриваются.
+        """
+        sub = self.neighbours[seen]
+        if not sub.nnz:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float64)
+        weighted = sub.data * np.repeat(ratings, np.diff(sub.indptr))
+        candidates, inverse = np.unique(sub.indices, return_inverse=True)
+        return candidates, np.bincount(inverse, weights=weighted, minlength=len(candidates))
+
+    def score_items(self, seen: np.ndarray, ratings: np.ndarray, items: np.ndarray) -> np.ndarray:
+        """Оценки score для заданных видео items (0 для видео вне соседей просмотренных)."""
+        candidates, scores = self.score(seen, ratings)
+        result = np.zeros(len(items), dtype=np.float64)
+        if len(candidates):
+            positions = np.minimum(np.searchsorted(candidates, items), len(candidates) - 1)
+            found = candidates[positions] == items
+            result[found] = scores[positions[found]]
+        return result
+
+    def _entry_rows(self) -> np.ndarray:
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.neighbours.indptr))
+
+    def resized(self, n: int) -> "TopKSimilarityIndex":
+        """Индекс для каталога из n >= shape[0] видео; новые строки пусты."""
+        indptr = self.neighbours.indptr
+        indptr = np.concatenate([indptr, np.full(n - self.shape[0], indptr[-1], dtype=indptr.dtype)])
+        return TopKSimilarityIndex(
+            sp.csr_matrix((self.neighbours.data, self.neighbours.indices, indptr), shape=(n, n)), self.k
+        )
+
+    def without(self, removed: np.ndarray) -> "TopKSimilarityIndex":
+        """Индекс без видео removed; номера остальных видео сдвигаются."""
+        n = self.shape[0]
+        keep = np.ones(n, dtype=bool)
+        keep[removed] = False
+        remap = np.cumsum(keep) - 1
+        entry_rows = self._entry_rows()
+        mask = keep[entry_rows] & keep[self.neighbours.indices]
+        m = int(keep.sum())
+        indptr = np.zeros(m + 1, dtype=np.int64)
+        np.cumsum(np.bincount(remap[entry_rows[mask]], minlength=m), out=indptr[1:])
+        neighbours = sp.csr_matrix(
+            (self.neighbours.data[mask], remap[self.neighbours.indices[mask]].astype(np.int32), indptr), shape=(m, m)
+        )
+        return TopKSimilarityIndex(neighbours, self.k)
+
+    def rows_referencing(self, cols: np.ndarray) -> np.ndarray:
+        """Строки, в списках соседей которых есть хотя бы одно из видео cols."""
+        return np.unique(self._entry_rows()[np.isin(self.neighbours.indices, cols)])
+
+    def rows_admitting(self, cols: np.ndarray, block: np.ndarray) -> np.ndarray:
+        """Строки, в чьи списки соседей войдёт хотя бы одно из видео cols.
+
+        block[i, j] - схожесть видео cols[i] с видео j. Неполные строки
+        принимают любое видео, заполненные - только более похожее, чем
+        худший из текущих соседей.
+        """
+        n = self.shape[0]
+        k = max(0, min(self.k, n - 1))
+        if k == 0:
+            return np.empty(0, dtype=np.int64)
+        counts = np.diff(self.neighbours.indptr)
+        threshold = np.full(n, -np.inf)
+        full = counts >= k
+        if full.any():
+            nonempty = counts > 0
+            worst = np.minimum.reduceat(self.neighbours.data, self.neighbours.indptr[:-1][nonempty])
+            threshold[nonempty] = np.where(full[nonempty], worst, -np.inf)
+        candidates = block.copy()
+        candidates[np.arange(len(cols)), cols] = -np.inf
+        return np.flatnonzero((candidates > threshold).any(axis=0))
+
+    def with_recomputed_rows(self, rows: np.ndarray, block_similarity: Callable[[np.ndarray], np.ndarray],
+                             block_size: int = 1024) -> "TopKSimilarityIndex":
+        """Новый индекс, в котором списки соседей строк rows посчитаны заново.
+
+        block_similarity(rows) возвращает схожесть видео rows со всеми видео;
+        остальные строки переносятся без изменений.
+        """
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        if not len(rows):
+            return self
+        n = self.shape[0]
+        k = max(0, min(self.k, n - 1))
+        new_indices = np.empty((len(rows), k), dtype=np.int32)
+        new_data = np.empty((len(rows), k), dtype=np.float64)
+        for start in range(0, len(rows), block_size):
+            part = rows[start:start + block_size]
+            block = block_similarity(part)
+            block[np.arange(len(part)), part] = -np.inf
+            new_indices[start:start + len(part)], new_data[start:start + len(part)] = _top_k(block, k)
+
+        old_counts = np.diff(self.neighbours.indptr)
+        counts = old_counts.copy()
+        counts[rows] = k
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        data = np.empty(indptr[-1], dtype=np.float64)
+        keep = np.ones(n, dtype=bool)
+        keep[rows] = False
+        # Неизменённые строки копируются одним векторным присваиванием
+        indices[np.repeat(keep, counts)] = self.neighbours.indices[np.repeat(keep, old_counts)]
+        data[np.repeat(keep, counts)] = self.neighbours.data[np.repeat(keep, old_counts)]
+        positions = (indptr[rows][:, None] + np.arange(k)).ravel()
+        indices[positions] = new_indices.ravel()
+        data[positions] = new_data.ravel()
+        logger.debug("Recomputed %d rows of top-%d similarity index", len(rows), k)
+        return TopKSimilarityIndex(sp.csr_matrix((data, indices, indptr), shape=(n, n)), self.k)
+
+    def pairs(self, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Уникальные пары (i, j, схожесть) с i < j для сохранения в БД.
+
+        С rows возвращаются только пары, в которых участвует хотя бы одно из
+        этих видео.
+        """
+        coo = self.neighbours.tocoo()
+        entry_rows, entry_cols, values = coo.row, coo.col, coo.data
+        if rows is not None:
+            incident = np.isin(entry_rows, rows) | np.isin(entry_cols, rows)
+            entry_rows, entry_cols, values = entry_rows[incident], entry_cols[incident], values[incident]
+        pair_rows = np.minimum(entry_rows, entry_cols).astype(np.int64)
+        pair_cols = np.maximum(entry_rows, entry_cols).astype(np.int64)
+        _, first = np.unique(pair_rows * self.shape[0] + pair_cols, return_index=True)
+        return pair_rows[first], pair_cols[first], values[first]
+
+    def to_dense(self) -> np.ndarray:
+        dense = self.neighbours.toarray()
+        np.fill_diagonal(dense, 1.0)
+        return dense
+
+    def memory_usage(self) -> int:
+        return int(self.neighbours.data.nbytes + self.neighbours.indices.nbytes + self.neighbours.indptr.nbytes)
@@ -0,0 +1,34 @@
+from dataclasses import dataclass, replace
+from typing import Any, Dict, List, Optional
+from domain.user_item_matrix import UserItemMatrix
+
+
+@dataclass(frozen=True)
+class ModelSnapshot:
+    """Неизменяемое состояние рекомендателя.
+
+    Читатели берут ссылку на текущий снимок один раз и работают только с
+    ним; писатели строят новый снимок и публикуют его одним присваиванием.
+    similarity - np.ndarray (режим dense), TopKSimilarityIndex (режим topk)
+    или None, пока модель схожести не построена. embeddings -
+    EmbeddingIndex для отбора кандидатов или None (оценка по схожести).
+    """
+    video_ids: List[str]
+    video_index: Dict[str, int]
+    user_matrix: UserItemMatrix
+    similarity: Optional[Any] = None
+    embeddings: Optional[Any] = None
+    version: int = 0
+
+    @classmethod
+    def empty(cls, video_ids: List[str]) -> "ModelSnapshot":
+        video_ids = list(video_ids)
+        return cls(
+            video_ids=video_ids,
+            video_index={vid: i for i, vid in enumerate(video_ids)},
+            user_matrix=UserItemMatrix(video_ids)
+        )
+
+    def evolve(self, **changes) -> "ModelSnapshot":
+        """Новый снимок с заменёнными полями и следующим номером версии."""
+        return replace(self, version=self.version + 1, **changes)
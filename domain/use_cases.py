@@ -1,120 +1,730 @@
 import logging
+import threading
+import time
 import pandas as pd
 import numpy as np
-from typing import List, Dict, Tuple
-from domain.entities import Video, Interaction
+from typing import Callable, List, Dict, Optional, Tuple, Union
+from domain.cache import RecommendationCache
+from domain.entities import Video, Interaction, InteractionBatch
+from domain.embeddings import EmbeddingIndex, build_embedding_index
+from domain.metrics import REGISTRY, timed
+from domain.popularity import PopularityIndex
+from domain.similarity import GenreFeatures, TopKSimilarityIndex
+from domain.snapshot import ModelSnapshot
+from domain.user_item_matrix import UserItemMatrix, UserItemMatrixBuilder, action_scores_by_code
 from sklearn.metrics.pairwise import cosine_similarity
 from sklearn.preprocessing import MultiLabelBinarizer
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+RECOMMEND_SECONDS = REGISTRY.histogram(
+    "recommender_recommend_seconds", "Time to build recommendations for one user", ["outcome"]
+)
+RECOMMEND_BATCH_SECONDS = REGISTRY.histogram(
+    "recommender_recommend_batch_seconds", "Time to build recommendations for a batch of users"
+)
+MATRIX_UPDATE_SECONDS = REGISTRY.histogram(
+    "recommender_matrix_update_seconds", "Time to update the user-item matrix", ["operation"]
+)
+CATALOG_UPDATE_SECONDS = REGISTRY.histogram(
+    "recommender_catalog_update_seconds", "Time to apply a video catalog change", ["operation"]
+)
+INTERACTIONS_APPLIED = REGISTRY.counter(
+    "recommender_interactions_applied_total", "Interactions applied to the user-item matrix"
+)
+INTERACTIONS_SKIPPED = REGISTRY.counter(
+    "recommender_interactions_skipped_total", "Interactions skipped because of an unknown video_id"
+)
+
+SIMILARITY_DENSE = "dense"
+SIMILARITY_TOPK = "topk"
+SIMILARITY_NOISE = 0.01
+
+# Источник рекомендаций: популярное (новые, холодные и пользователи без кандидатов) или модель
+TIER_POPULAR = "popular"
+TIER_PERSONAL = "personal"
+
+def _min_max(scores: np.ndarray) -> np.ndarray:
+    return (scores - scores.min()) / (scores.max() - scores.min() + 1e-8)
+
+def _similarity_scores(similarity, seen: np.ndarray, ratings: np.ndarray, items: np.ndarray) -> np.ndarray:
+    """Оценки по схожести только для видео items (как в точном пути)."""
+    if isinstance(similarity, TopKSimilarityIndex):
+        return similarity.score_items(seen, ratings, items)
+    return similarity[np.ix_(items, seen)] @ ratings
+
+def _top_n(scores: np.ndarray, n: int) -> np.ndarray:
+    """Индексы n лучших оценок в каждой строке (по убыванию) через argpartition."""
+    n = min(n, scores.shape[-1])
+    if n <= 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+    top = np.argpartition(-scores, n - 1, axis=-1)[..., :n]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=-1), axis=-1, kind="stable")
+    return np.take_along_axis(top, order, axis=-1)
+
+def build_video_similarity(videos: List[Video], similarity_mode: str = SIMILARITY_DENSE, top_k: int = 50):
+    """Вычисление схожести видео на основе жанров.
+
+    Чистая функция без состояния рекомендателя, поэтому её можно выполнять
+    в отдельном процессе; порядок строк совпадает с порядком videos.
+    """
+    if not videos:
+        logger.error("No videos available for similarity computation")
+        raise ValueError("Empty video list")
+
+    mlb = MultiLabelBinarizer()
+    genres = [v.genres or [] for v in videos]
+    if not any(genres):
+        logger.error("No genres available for any video")
+        raise ValueError("No valid genres")
+
+    genre_matrix = mlb.fit_transform(genres)
+    logger.debug("Genre matrix shape: %s, classes: %s", genre_matrix.shape, mlb.classes_)
+
+    if similarity_mode == SIMILARITY_TOPK:
+        # Add small noise to avoid uniform similarities
+        index = TopKSimilarityIndex.from_features(genre_matrix, top_k, noise=SIMILARITY_NOISE)
+        logger.info("Computed top-%d video similarity index, memory: %d bytes", top_k, index.memory_usage())
+        return index
+
+    similarity = cosine_similarity(genre_matrix)
+    # Add small noise to avoid uniform similarities
+    similarity += np.random.normal(0, SIMILARITY_NOISE, similarity.shape)
+    np.fill_diagonal(similarity, 1.0)  # Ensure self-similarity is 1
+    logger.info("Computed video similarity matrix with shape: %s", similarity.shape)
+    return similarity
+
 class Recommender:
-    def __init__(self, videos: List[Video], action_weights: Dict[str, float]):
+    def __init__(self, videos: List[Video], action_weights: Dict[str, float],
+                 similarity_mode: str = SIMILARITY_DENSE, top_k: int = 50,
+                 cache: Optional[RecommendationCache] = None, popularity_half_life: float = 86400.0,
+                 cold_start_min_items: int = 1, rerank_weight: float = 0.3, rerank_depth: int = 10,
+                 ann_nprobe: Optional[int] = None):
+        if similarity_mode not in (SIMILARITY_DENSE, SIMILARITY_TOPK):
+            raise ValueError(f"Unknown similarity mode: {similarity_mode}")
         self.videos = {v.id: v for v in videos}
-        self.video_ids = list(self.videos.keys())
         self.action_weights = action_weights
-        self.user_item_matrix = None
-        self.video_similarity = None
-        logger.info("Recommender initialized with %d videos", len(self.videos))
+        self.smoothing_factor = 0.1
+        self.similarity_mode = similarity_mode
+        self.top_k = top_k
+        self.cache = cache
+        # Писатели сериализуются, читатели берут self._snapshot без блокировок
+        self._write_lock = threading.Lock()
+        self._snapshot = ModelSnapshot.empty(list(self.videos.keys()))
+        # Слияние изменённых строк матрицы в CSR идёт в фоновом потоке, не более одного за раз
+        self._compacting = False
+        # Векторы жанров нужны только писателям при изменении каталога и строятся при первом изменении
+        self._features: Optional[Tuple[List[str], GenreFeatures]] = None
+        # Пользователи с меньшим числом просмотренных видео получают популярное без обращения к модели схожести
+        self.cold_start_min_items = cold_start_min_items
+        self.popularity = PopularityIndex(self.video_ids, [v.genres for v in self.videos.values()],
+                                          half_life=popularity_half_life)
+        # Отбор кандидатов по эмбеддингам: сколько брать на одну рекомендацию и вес жанровой схожести
+        self.rerank_weight = rerank_weight
+        self.rerank_depth = rerank_depth
+        self.ann_nprobe = ann_nprobe
+        logger.info("Recommender initialized with %d videos, similarity mode: %s", len(self.videos), similarity_mode)
+
+    @property
+    def snapshot(self) -> ModelSnapshot:
+        """Текущий неизменяемый снимок модели."""
+        return self._snapshot
+
+    @property
+    def video_ids(self) -> List[str]:
+        return self._snapshot.video_ids
+
+    @property
+    def user_item_matrix(self) -> UserItemMatrix:
+        return self._snapshot.user_matrix
+
+    @property
+    def video_similarity(self) -> Optional[pd.DataFrame]:
+        """Матрица схожести видео в виде DataFrame (для сохранения в БД)."""
+        snapshot = self._snapshot
+        if snapshot.similarity is None:
+            return None
+        values = snapshot.similarity
+        if isinstance(values, TopKSimilarityIndex):
+            values = values.to_dense()
+        return pd.DataFrame(values, index=snapshot.video_ids, columns=snapshot.video_ids)
+
+    @video_similarity.setter
+    def video_similarity(self, matrix: Optional[pd.DataFrame]):
+        """Установка матрицы схожести с выравниванием по порядку self.video_ids."""
+        if matrix is None:
+            self._set_similarity(None)
+            return
+        aligned = matrix.reindex(index=self.video_ids, columns=self.video_ids, fill_value=0.0)
+        values = np.ascontiguousarray(aligned.to_numpy(dtype=np.float64))
+        if self.similarity_mode == SIMILARITY_TOPK:
+            values = TopKSimilarityIndex.from_dense(values, self.top_k)
+        self._set_similarity(values)
+
+    def _set_similarity(self, similarity):
+        """Публикация снимка с новой моделью схожести; кэш рекомендаций сбрасывается."""
+        with self._write_lock:
+            self._snapshot = self._snapshot.evolve(similarity=similarity)
+        if self.cache is not None:
+            self.cache.clear()
+
+    def _invalidate_users(self, user_ids):
+        if self.cache is not None:
+            for user_id in user_ids:
+                self.cache.invalidate_user(user_id)
+
+    def popular(self, n: int = 10, genre: Optional[str] = None) -> List[Tuple[str, float]]:
+        """n самых популярных видео (с учётом затухания), при необходимости одного жанра."""
+        return self.popularity.top(n, genre)
+
+    def similarity_pairs(self, video_ids: Optional[List[str]] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Пары (video1_id, video2_id, схожесть) с положительной схожестью для сохранения в БД.
+
+        С video_ids возвращаются только пары, в которых участвует хотя бы одно
+        из этих видео (неизвестные id пропускаются).
+        """
+        snapshot = self._snapshot
+        if snapshot.similarity is None:
+            raise ValueError("Video similarity matrix is not initialized")
+        selected = None
+        if video_ids is not None:
+            selected = np.array([snapshot.video_index[v] for v in video_ids if v in snapshot.video_index],
+                                dtype=np.int64)
+        if isinstance(snapshot.similarity, TopKSimilarityIndex):
+            rows, cols, values = snapshot.similarity.pairs(selected)
+        elif selected is not None:
+            n = len(snapshot.video_ids)
+            others = np.tile(np.arange(n), len(selected))
+            mine = np.repeat(selected, n)
+            keys = np.unique(np.minimum(mine, others) * n + np.maximum(mine, others))
+            rows, cols = keys // n, keys % n
+            values = np.asarray(snapshot.similarity[rows, cols])
+        else:
+            rows, cols = np.nonzero(np.triu(snapshot.similarity > 0))
+            values = snapshot.similarity[rows, cols]
+        positive = values > 0
+        video_ids = np.asarray(snapshot.video_ids, dtype=object)
+        return video_ids[rows[positive]], video_ids[cols[positive]], values[positive]
+
+    def set_similarity_pairs(self, video1_ids: np.ndarray, video2_ids: np.ndarray, similarity: np.ndarray):
+        """Установка схожести из пар, загруженных из БД; пары считаются симметричными."""
+        index = pd.Index(self.video_ids)
+        rows, cols = index.get_indexer(video1_ids), index.get_indexer(video2_ids)
+        known = (rows >= 0) & (cols >= 0)
+        rows, cols, similarity = rows[known], cols[known], np.asarray(similarity, dtype=np.float64)[known]
+        rows, cols = np.concatenate([rows, cols]), np.concatenate([cols, rows])
+        similarity = np.concatenate([similarity, similarity])
+        if self.similarity_mode == SIMILARITY_TOPK:
+            self._set_similarity(TopKSimilarityIndex.from_pairs(rows, cols, similarity, len(self.video_ids), self.top_k))
+        else:
+            values = np.zeros((len(self.video_ids), len(self.video_ids)), dtype=np.float64)
+            values[rows, cols] = similarity
+            self._set_similarity(values)
+        logger.info("Loaded video similarity from %d pairs", known.sum())
 
     def compute_video_similarity(self):
         """Вычисление матрицы схожести видео на основе жанров."""
         try:
-            if not self.videos:
-                logger.error("No videos available for similarity computation")
-                raise ValueError("Empty video list")
-
-            mlb = MultiLabelBinarizer()
-            genres = [v.genres or [] for v in self.videos.values()]
-            if not any(genres):
-                logger.error("No genres available for any video")
-                raise ValueError("No valid genres")
-
-            genre_matrix = mlb.fit_transform(genres)
-            logger.debug("Genre matrix shape: %s, classes: %s", genre_matrix.shape, mlb.classes_)
-
-            similarity = cosine_similarity(genre_matrix)
-            # Add small noise to avoid uniform similarities
-            similarity += np.random.normal(0, 0.01, similarity.shape)
-            np.fill_diagonal(similarity, 1.0)  # Ensure self-similarity is 1
-            self.video_similarity = pd.DataFrame(
-                similarity,
-                index=self.video_ids,
-                columns=self.video_ids
-            )
-            logger.info("Computed video similarity matrix with shape: %s", self.video_similarity.shape)
+            self._set_similarity(build_video_similarity(list(self.videos.values()), self.similarity_mode, self.top_k))
         except Exception as e:
             logger.error(f"Error computing video similarity: {e}", exc_info=True)
             raise
 
-    def update_user_item_matrix(self, interactions: List[Interaction], user_id: str = None) -> pd.DataFrame:
-        """Обновление матрицы пользователь-элемент."""
+    def install_similarity(self, similarity):
+        """Установка модели схожести, построенной build_video_similarity вне этого объекта."""
+        expected = len(self.video_ids)
+        if similarity.shape != (expected, expected):
+            raise ValueError(f"Similarity shape {similarity.shape} does not match {expected} videos")
+        self._set_similarity(similarity)
+
+    def compute_embeddings(self, **kwargs) -> EmbeddingIndex:
+        """Факторизация текущей матрицы пользователь-элемент и IVF-индекс (параметры build_embedding_index)."""
+        snapshot = self._snapshot
+        index = build_embedding_index(snapshot.user_matrix.to_csr(), **kwargs)
+        self.install_embeddings(index, snapshot.video_ids)
+        return index
+
+    def install_embeddings(self, index: Optional[EmbeddingIndex], video_ids: Optional[List[str]] = None) -> bool:
+        """Включение отбора кандидатов по эмбеддингам; None - возврат к точной оценке по схожести.
+
+        video_ids - каталог, по которому обучен index (например, при
+        переобучении в фоне). Видео, добавленные после, получают пустые
+        строки; если видео с тех пор удалялись, индекс устаревший и не
+        устанавливается (возвращается False).
+        """
+        with self._write_lock:
+            current = self._snapshot.video_ids
+            if index is not None and video_ids is not None and video_ids is not current:
+                if current[:len(video_ids)] != video_ids:
+                    logger.warning("Catalog changed while embeddings were trained; discarding the index")
+                    return False
+                index = index.with_items(len(current) - len(video_ids))
+            if index is not None and index.n_items != len(current):
+                raise ValueError(f"Embedding index has {index.n_items} videos, expected {len(current)}")
+            self._snapshot = self._snapshot.evolve(embeddings=index)
+        if self.cache is not None:
+            self.cache.clear()
+        return True
+
+    def _catalog_features(self, snapshot: ModelSnapshot) -> GenreFeatures:
+        """Векторы жанров в порядке видео снимка (вызывается под _write_lock)."""
+        if self._features is None or self._features[0] is not snapshot.video_ids:
+            features = GenreFeatures.from_genres([self.videos[vid].genres or [] for vid in snapshot.video_ids])
+            self._features = (snapshot.video_ids, features)
+        return self._features[1]
+
+    def _similarity_rows(self, features: GenreFeatures, rows: np.ndarray) -> np.ndarray:
+        # Add small noise to avoid uniform similarities (как в build_video_similarity)
+        return features.similarity(rows, noise=SIMILARITY_NOISE)
+
+    @timed(CATALOG_UPDATE_SECONDS.labels("upsert"))
+    def upsert_videos(self, videos: List[Video]) -> List[str]:
+        """Добавление новых видео и обновление жанров существующих без полной перестройки.
+
+        Схожесть считается только для изменённых строк: в плотном режиме
+        заменяются их строки и столбцы, в режиме topk дополнительно
+        пересчитываются списки соседей видео, в которые изменённые видео
+        входили или теперь войдут. Новые видео добавляются в матрицу
+        пользователь-элемент пустыми столбцами. Возвращает id видео, пары
+        схожести которых изменились (для similarity_pairs и сохранения в БД).
+        """
+        videos = list({v.id: v for v in videos}.values())
+        if not videos:
+            return []
+        with self._write_lock:
+            snapshot = self._snapshot
+            features = self._catalog_features(snapshot)
+            new_ids = [v.id for v in videos if v.id not in snapshot.video_index]
+            video_ids = snapshot.video_ids + new_ids
+            video_index = {**snapshot.video_index, **{vid: len(snapshot.video_ids) + i for i, vid in enumerate(new_ids)}}
+            n = len(video_ids)
+            changed = np.array([video_index[v.id] for v in videos], dtype=np.int64)
+            features = features.with_rows(changed, [v.genres or [] for v in videos], n)
+
+            similarity, affected = snapshot.similarity, changed
+            if isinstance(similarity, TopKSimilarityIndex):
+                index = similarity.resized(n) if n > similarity.shape[0] else similarity
+                block = self._similarity_rows(features, changed)
+                affected = np.union1d(changed, np.union1d(index.rows_referencing(changed),
+                                                          index.rows_admitting(changed, block)))
+                similarity = index.with_recomputed_rows(affected, lambda rows: self._similarity_rows(features, rows))
+            elif similarity is not None:
+                values = np.zeros((n, n), dtype=np.float64)
+                values[:similarity.shape[0], :similarity.shape[1]] = similarity
+                block = self._similarity_rows(features, changed)
+                values[changed, :] = block
+                values[:, changed] = block.T
+                values[changed, changed] = 1.0  # Ensure self-similarity is 1
+                similarity = values
+
+            user_matrix = snapshot.user_matrix.with_items(new_ids) if new_ids else snapshot.user_matrix
+            updated = [v for v in videos if v.id in snapshot.video_index]
+            self.popularity.set_genres([snapshot.video_index[v.id] for v in updated], [v.genres for v in updated])
+            self.popularity.extend(new_ids, [v.genres for v in videos if v.id not in snapshot.video_index])
+            self.popularity.refresh()
+            self.videos = {**self.videos, **{v.id: v for v in videos}}
+            # У новых видео векторов нет до переобучения: в кандидаты их добавляет схожесть (_retrieve)
+            embeddings = snapshot.embeddings.with_items(len(new_ids)) if snapshot.embeddings is not None else None
+            self._snapshot = snapshot.evolve(video_ids=video_ids, video_index=video_index,
+                                             user_matrix=user_matrix, similarity=similarity, embeddings=embeddings)
+            self._features = (video_ids, features)
+        if self.cache is not None:
+            self.cache.clear()
+        logger.info("Upserted %d videos (%d new), %d similarity rows recomputed", len(videos), len(new_ids),
+                    len(affected))
+        return [video_ids[i] for i in affected.tolist()]
+
+    @timed(CATALOG_UPDATE_SECONDS.labels("remove"))
+    def remove_videos(self, video_ids: List[str]) -> List[str]:
+        """Удаление видео из модели без полной перестройки.
+
+        Столбцы удаляются из матрицы пользователь-элемент, в режиме topk
+        пересчитываются списки соседей, из которых выпали удалённые видео.
+        Возвращает id видео, пары схожести которых изменились, включая
+        удалённые.
+        """
+        with self._write_lock:
+            snapshot = self._snapshot
+            removed = np.unique([snapshot.video_index[v] for v in video_ids if v in snapshot.video_index]).astype(np.int64)
+            if not len(removed):
+                return []
+            features = self._catalog_features(snapshot).without(removed)
+            keep = np.ones(len(snapshot.video_ids), dtype=bool)
+            keep[removed] = False
+            remap = np.cumsum(keep) - 1
+            remaining = [vid for vid, kept in zip(snapshot.video_ids, keep.tolist()) if kept]
+
+            similarity, affected = snapshot.similarity, np.empty(0, dtype=np.int64)
+            if isinstance(similarity, TopKSimilarityIndex):
+                referencing = similarity.rows_referencing(removed)
+                affected = remap[referencing[keep[referencing]]]
+                similarity = similarity.without(removed).with_recomputed_rows(
+                    affected, lambda rows: self._similarity_rows(features, rows)
+                )
+            elif similarity is not None:
+                similarity = np.delete(np.delete(similarity, removed, axis=0), removed, axis=1)
+
+            removed_ids = [snapshot.video_ids[i] for i in removed.tolist()]
+            removed_set = set(removed_ids)
+            self.videos = {vid: v for vid, v in self.videos.items() if vid not in removed_set}
+            self.popularity.remove(removed)
+            self.popularity.refresh()
+            self._snapshot = snapshot.evolve(
+                video_ids=remaining,
+                video_index={vid: i for i, vid in enumerate(remaining)},
+                user_matrix=snapshot.user_matrix.without_items(removed),
+                similarity=similarity,
+                embeddings=snapshot.embeddings.without(removed) if snapshot.embeddings is not None else None
+            )
+            self._features = (remaining, features)
+        if self.cache is not None:
+            self.cache.clear()
+        logger.info("Removed %d videos, %d similarity rows recomputed", len(removed_ids), len(affected))
+        return removed_ids + [remaining[i] for i in affected.tolist()]
+
+    def _score(self, action: str) -> float:
+        return self.action_weights.get(action, 0.0) + self.smoothing_factor
+
+    def install_snapshot(self, snapshot: ModelSnapshot, popularity: Optional[np.ndarray] = None,
+                         popularity_as_of: Optional[float] = None):
+        """Публикация готового снимка (например, загруженного из артефакта).
+
+        popularity - сохранённые счётчики популярности на момент popularity_as_of;
+        без них популярность считается по суммам столбцов матрицы пользователь-элемент.
+        """
+        if snapshot.video_ids != self.video_ids:
+            raise ValueError("Snapshot video ids do not match recommender videos")
+        with self._write_lock:
+            self._snapshot = snapshot.evolve()
+            if popularity is None:
+                self.popularity.seed(snapshot.user_matrix.column_sums())
+            else:
+                self.popularity.seed(popularity, as_of=popularity_as_of)
+        if self.cache is not None:
+            self.cache.clear()
+
+    def matrix_builder(self, flush_threshold: int = 5_000_000) -> UserItemMatrixBuilder:
+        """Построитель матрицы для потоковой загрузки взаимодействий порциями."""
+        return UserItemMatrixBuilder(self.video_ids, self.action_weights, self.smoothing_factor,
+                                     flush_threshold=flush_threshold)
+
+    def retain_users(self, keep: Callable[[str], bool]) -> int:
+        """Удаление из матрицы пользователей, для которых keep ложно (например, чужих шардов).
+
+        Популярность не пересчитывается: она остаётся общей для всех
+        пользователей. Возвращает число оставшихся пользователей.
+        """
+        with self._write_lock:
+            snapshot = self._snapshot
+            matrix = snapshot.user_matrix.with_users([u for u in snapshot.user_matrix.user_ids if keep(u)])
+            self._snapshot = snapshot.evolve(user_matrix=matrix)
+        if self.cache is not None:
+            self.cache.clear()
+        logger.info("Retained %d of %d users", len(matrix), len(snapshot.user_matrix))
+        return len(matrix)
+
+    def _schedule_compaction(self, matrix: UserItemMatrix):
+        """Запуск фонового слияния matrix, если изменённых строк накопилось много (вызывает писатель)."""
+        if self._compacting or not matrix.needs_compaction:
+            return
+        self._compacting = True
+        threading.Thread(target=self._compact, args=(matrix,), name="user-item-compaction", daemon=True).start()
+
+    @timed(MATRIX_UPDATE_SECONDS.labels("compact"))
+    def _compact(self, matrix: UserItemMatrix):
+        """O(nnz) слияние без блокировки; под блокировкой переносятся только строки, изменённые за это время."""
         try:
-            smoothing_factor = 0.1
-            valid_users = set(i.user_id for i in interactions if i.video_id in self.video_ids)
-            logger.debug(f"Valid users: {valid_users}, target user_id: {user_id}")
-            if not valid_users:
-                logger.warning("No valid users or interactions for matrix update")
-                return self.user_item_matrix
-
-            users = [user_id] if user_id else list(valid_users)
-            items = self.video_ids
-
-            if self.user_item_matrix is None:
-                matrix = pd.DataFrame(0.0, index=users, columns=items)
+            compacted = matrix.compact()
+            with self._write_lock:
+                snapshot = self._snapshot
+                rebased = snapshot.user_matrix.rebase(matrix, compacted)
+                if rebased is not snapshot.user_matrix:
+                    self._snapshot = snapshot.evolve(user_matrix=rebased)
+        except Exception as e:
+            logger.error(f"Error compacting user-item matrix: {e}", exc_info=True)
+        finally:
+            self._compacting = False
+
+    def install_user_item_matrix(self, matrix: UserItemMatrix):
+        """Публикация полностью перестроенной матрицы пользователь-элемент."""
+        if matrix.item_ids != self.video_ids:
+            raise ValueError("User-item matrix columns do not match video ids")
+        with self._write_lock:
+            self._snapshot = self._snapshot.evolve(user_matrix=matrix)
+            self.popularity.seed(matrix.column_sums())
+        if self.cache is not None:
+            self.cache.clear()
+
+    @timed(MATRIX_UPDATE_SECONDS.labels("rebuild"))
+    def update_user_item_matrix(self, interactions: List[Interaction], user_id: str = None) -> UserItemMatrix:
+        """Обновление матрицы пользователь-элемент.
+
+        Без user_id матрица полностью перестраивается по всем взаимодействиям,
+        с user_id пересчитывается только строка этого пользователя.
+        """
+        try:
+            if user_id is None:
+                matrix = UserItemMatrix.from_interactions(self.video_ids, interactions, self._score)
+                if not len(matrix):
+                    logger.warning("No valid users or interactions for matrix update")
+                    return self.user_item_matrix
+                self.install_user_item_matrix(matrix)
             else:
-                matrix = self.user_item_matrix.copy()
-                new_users = [u for u in users if u not in matrix.index]
-                if new_users:
-                    logger.debug("Adding new users: %s", new_users)
-                    new_rows = pd.DataFrame(0.0, index=new_users, columns=items)
-                    matrix = pd.concat([matrix, new_rows])
-                if user_id and user_id in matrix.index:
-                    matrix.loc[user_id] = 0.0
-
-            for interaction in interactions:
-                if interaction.user_id in valid_users and interaction.video_id in self.video_ids:
-                    score = self.action_weights.get(interaction.action, 0.0) + smoothing_factor
-                    try:
-                        matrix.loc[interaction.user_id, interaction.video_id] += score
-                    except KeyError as e:
-                        logger.error(f"KeyError in matrix update: {e}, user_id: {interaction.user_id}, video_id: {interaction.video_id}")
-                        continue
-
-            self.user_item_matrix = matrix
-            logger.info(f"User-item matrix updated with shape: {matrix.shape}, users: {matrix.index.tolist()}")
+                row = np.zeros(len(self.video_ids), dtype=np.float64)
+                item_index = self._snapshot.video_index
+                for interaction in interactions:
+                    col = item_index.get(interaction.video_id)
+                    if interaction.user_id == user_id and col is not None:
+                        row[col] += self._score(interaction.action)
+                indices = np.flatnonzero(row)
+                with self._write_lock:
+                    snapshot = self._snapshot
+                    matrix = snapshot.user_matrix.with_row(user_id, indices, row[indices])
+                    self._snapshot = snapshot.evolve(user_matrix=matrix)
+                self._schedule_compaction(matrix)
+                self._invalidate_users([user_id])
+
+            logger.info("User-item matrix updated with shape: %s, nnz: %d, memory: %d bytes",
+                        matrix.shape, matrix.nnz, matrix.memory_usage())
             return matrix
         except Exception as e:
             logger.error(f"Error updating user-item matrix: {e}", exc_info=True)
             raise
 
+    @timed(MATRIX_UPDATE_SECONDS.labels("apply_interaction"))
+    def apply_interaction(self, interaction: Interaction) -> bool:
+        """Инкрементальное обновление одной ячейки матрицы пользователь-элемент.
+
+        В отличие от update_user_item_matrix не требует полной истории
+        взаимодействий: к ячейке (user_id, video_id) добавляется вес действия.
+        Полная перестройка остаётся доступной для сверки.
+        """
+        if interaction.video_id not in self._snapshot.video_index:
+            logger.warning("Unknown video_id %s in interaction, skipping", interaction.video_id)
+            INTERACTIONS_SKIPPED.inc()
+            return False
+
+        score = self._score(interaction.action)
+        with self._write_lock:
+            snapshot = self._snapshot
+            matrix = snapshot.user_matrix.with_value(interaction.user_id, interaction.video_id, score)
+            self._snapshot = snapshot.evolve(user_matrix=matrix)
+            self.popularity.add(np.array([snapshot.video_index[interaction.video_id]]), np.array([score]))
+        self._schedule_compaction(matrix)
+        self._invalidate_users([interaction.user_id])
+        INTERACTIONS_APPLIED.inc()
+        logger.debug("Applied interaction %s -> %s (+%.2f)", interaction.user_id, interaction.video_id, score)
+        return True
+
+    @timed(MATRIX_UPDATE_SECONDS.labels("apply_interactions"))
+    def apply_interactions(self, interactions: Union[List[Interaction], InteractionBatch]) -> int:
+        """Применение пачки взаимодействий одним векторным обновлением матрицы."""
+        batch = interactions if isinstance(interactions, InteractionBatch) else InteractionBatch.from_interactions(interactions)
+        scores = action_scores_by_code(self.action_weights, self.smoothing_factor)
+        with self._write_lock:
+            snapshot = self._snapshot
+            item_index = snapshot.video_index
+            cols = np.fromiter((item_index.get(v, -1) for v in batch.video_ids), dtype=np.int32, count=len(batch))
+            known = cols >= 0
+            user_ids = batch.user_ids[known]
+            values = scores[batch.action_codes[known]]
+            matrix = snapshot.user_matrix.with_batch(user_ids, cols[known], values)
+            self._snapshot = snapshot.evolve(user_matrix=matrix)
+            self.popularity.add(cols[known], values)
+        self._schedule_compaction(matrix)
+        applied = int(known.sum())
+        if applied < len(batch):
+            logger.warning("Skipping %d interactions with unknown video_id", len(batch) - applied)
+            INTERACTIONS_SKIPPED.inc(len(batch) - applied)
+        self._invalidate_users(set(user_ids.tolist()))
+        INTERACTIONS_APPLIED.inc(applied)
+        logger.debug("Applied batch of %d interactions", applied)
+        return applied
+
     def recommend(self, user_id: str, n: int = 3) -> List[Tuple[str, float]]:
         """Генерация рекомендаций для пользователя."""
+        return self.recommend_with_tier(user_id, n)[0]
+
+    def recommend_with_tier(self, user_id: str, n: int = 3) -> Tuple[List[Tuple[str, float]], str]:
+        """Рекомендации и их источник: TIER_PERSONAL (модель) или TIER_POPULAR.
+
+        Источник определяется тем же снимком, по которому посчитан ответ. В
+        кэш попадают только персональные рекомендации, поэтому попадание в
+        кэш - всегда TIER_PERSONAL.
+        """
+        # Токен кэша берётся до снимка: результат по устаревшему снимку в кэш не попадёт
+        started = time.perf_counter()
+        outcome = "computed"
+        token = self.cache.generation if self.cache is not None else None
+        snapshot = self._snapshot
+        video_ids = snapshot.video_ids
         try:
-            logger.info(f"Generating recommendations for user_id: {user_id}")
-            if self.user_item_matrix is None or user_id not in self.user_item_matrix.index:
-                logger.warning(f"User {user_id} not found in user_item_matrix")
-                return [(vid, 0.0) for vid in self.video_ids[:n]]
+            if self.cache is not None:
+                cached = self.cache.get(user_id, n)
+                if cached is not None:
+                    outcome = "cache_hit"
+                    return cached, TIER_PERSONAL
+
+            logger.debug("Generating recommendations for user_id: %s", user_id)
+            if user_id not in snapshot.user_matrix:
+                # Неизвестные пользователи - обычный случай, счётчик в метриках вместо warning на каждый запрос
+                logger.debug("User %s not found in user_item_matrix", user_id)
+                outcome = "unknown_user"
+                return self.popularity.top(n), TIER_POPULAR
 
-            if self.video_similarity is None:
+            seen, ratings = snapshot.user_matrix.row(user_id)
+            if len(seen) < self.cold_start_min_items:
+                outcome = "cold_start"
+                return self.popularity.top(n, exclude={video_ids[i] for i in seen}), TIER_POPULAR
+
+            if snapshot.similarity is None and snapshot.embeddings is None:
                 logger.warning("Video similarity matrix is not initialized")
-                return [(vid, 0.0) for vid in self.video_ids[:n]]
+                outcome = "fallback"
+                return self.popularity.top(n, exclude={video_ids[i] for i in seen}), TIER_POPULAR
 
-            user_ratings = self.user_item_matrix.loc[user_id]
-            scores = self.video_similarity.dot(user_ratings)
-            # Normalize scores to improve diversity
-            scores = (scores - scores.min()) / (scores.max() - scores.min() + 1e-8)
-            scores = scores.sort_values(ascending=False)
-            recommended = [(vid, float(score)) for vid, score in scores.items()
-                           if user_ratings.get(vid, 0) == 0][:n]
-            
+            if snapshot.embeddings is not None:
+                outcome = "retrieved"
+            recommended = self._rank(snapshot, seen, ratings, n)
             if not recommended:
-                logger.warning(f"No recommendations for user {user_id}; falling back to popular videos")
-                recommended = [(vid, 0.0) for vid in self.video_ids[:n]]
+                logger.debug("No recommendations for user %s; falling back to popular videos", user_id)
+                outcome = "fallback"
+                return self.popularity.top(n, exclude={video_ids[i] for i in seen}), TIER_POPULAR
 
-            logger.info(f"Generated {len(recommended)} recommendations for {user_id}: {recommended}")
-            return recommended
+            if self.cache is not None:
+                self.cache.put(user_id, n, recommended, token)
+            logger.debug("Generated %d recommendations for %s: %s", len(recommended), user_id, recommended)
+            return recommended, TIER_PERSONAL
         except Exception as e:
             logger.error(f"Error generating recommendations for user {user_id}: {e}", exc_info=True)
-            return [(vid, 0.0) for vid in self.video_ids[:n]]
\ No newline at end of file
+            outcome = "error"
+            return [(vid, 0.0) for vid in video_ids[:n]], TIER_POPULAR
+        finally:
+            RECOMMEND_SECONDS.labels(outcome).observe(time.perf_counter() - started)
+
+    def _retrieve(self, snapshot: ModelSnapshot, seen: np.ndarray, ratings: np.ndarray,
+                  n: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Кандидаты из IVF-индекса эмбеддингов, переранжированные жанровой схожестью.
+
+        Индекс отдаёт n * rerank_depth ближайших видео (ann_nprobe ячеек, по
+        умолчанию - nprobe индекса), после чего их оценка смешивается с
+        оценкой по схожести (как в точном пути, но только по кандидатам) с
+        весом rerank_weight. Видео без векторов (добавленные после обучения)
+        становятся кандидатами, если их находит схожесть; их оценка по
+        эмбеддингам заменяется оценкой по схожести.
+        """
+        index = snapshot.embeddings
+        candidates, scores = index.search(index.user_vector(seen, ratings), n * self.rerank_depth,
+                                          nprobe=self.ann_nprobe, exclude=seen)
+        similarity = snapshot.similarity
+        if similarity is None:
+            return candidates, scores
+        unindexed = index.unindexed()
+        if not len(unindexed) and (not self.rerank_weight or not len(candidates)):
+            return candidates, scores
+        items = np.concatenate([candidates, unindexed])
+        genre_scores = _similarity_scores(similarity, seen, ratings, items)
+        if isinstance(similarity, TopKSimilarityIndex) and len(unindexed):
+            # Соседи нового видео посчитаны при добавлении, а в списки соседей просмотренных оно могло не войти
+            genre_scores[len(candidates):] = np.maximum(genre_scores[len(candidates):],
+                                                        similarity.neighbours[unindexed][:, seen] @ ratings)
+        keep = np.ones(len(items), dtype=bool)
+        keep[len(candidates):] = genre_scores[len(candidates):] > 0
+        items, genre_scores = items[keep], genre_scores[keep]
+        if not len(items):
+            return candidates, scores
+        genre_scores = _min_max(genre_scores)
+        embedding_scores = genre_scores.copy()
+        if len(candidates):
+            embedding_scores[:len(candidates)] = _min_max(scores)
+        return items, (1 - self.rerank_weight) * embedding_scores + self.rerank_weight * genre_scores
+
+    def _rank(self, snapshot: ModelSnapshot, seen: np.ndarray, ratings: np.ndarray, n: int) -> List[Tuple[str, float]]:
+        """n лучших непросмотренных видео: через индекс эмбеддингов или точно по схожести."""
+        video_ids, similarity = snapshot.video_ids, snapshot.similarity
+        if snapshot.embeddings is not None:
+            candidates, scores = self._retrieve(snapshot, seen, ratings, n)
+        elif isinstance(similarity, TopKSimilarityIndex):
+            candidates, scores = similarity.score(seen, ratings)
+        else:
+            candidates = np.arange(len(video_ids))
+            scores = similarity[:, seen] @ ratings
+
+        if not len(scores):
+            return []
+        # Normalize scores to improve diversity
+        scores = _min_max(scores)
+        scores[np.isin(candidates, seen)] = -np.inf
+        order = _top_n(scores, n)
+        return [(video_ids[candidates[i]], float(scores[i])) for i in order if np.isfinite(scores[i])]
+
+    @timed(RECOMMEND_BATCH_SECONDS)
+    def recommend_batch(self, user_ids: List[str], n: int = 3,
+                        block_size: int = 256) -> Dict[str, List[Tuple[str, float]]]:
+        """Рекомендации для многих пользователей одним матричным умножением на блок.
+
+        Строки пользователей складываются в разреженную матрицу R, оценки
+        считаются как R @ S.T, просмотренные видео маскируются векторно,
+        а n лучших выбираются через argpartition без полной сортировки.
+        С индексом эмбеддингов поиск выполняется по одному пользователю.
+        """
+        token = self.cache.generation if self.cache is not None else None
+        snapshot = self._snapshot
+        video_ids, similarity, user_matrix = snapshot.video_ids, snapshot.similarity, snapshot.user_matrix
+        scorable = similarity is not None or snapshot.embeddings is not None
+        popular = self.popularity.ranking
+        results: Dict[str, List[Tuple[str, float]]] = {}
+        pending = []
+        for user_id in dict.fromkeys(user_ids):
+            cached = self.cache.get(user_id, n) if self.cache is not None else None
+            if cached is not None:
+                results[user_id] = cached
+            elif user_id not in user_matrix:
+                results[user_id] = popular.top(n)
+            elif scorable and user_matrix.row(user_id)[0].size >= self.cold_start_min_items:
+                pending.append(user_id)
+            else:
+                results[user_id] = popular.top(n, exclude={video_ids[i] for i in user_matrix.row(user_id)[0]})
+
+        if snapshot.embeddings is not None:
+            for user_id in pending:
+                seen, ratings = user_matrix.row(user_id)
+                recommended = self._rank(snapshot, seen, ratings, n)
+                if recommended and self.cache is not None:
+                    self.cache.put(user_id, n, recommended, token)
+                results[user_id] = recommended or popular.top(n, exclude={video_ids[i] for i in seen})
+            pending = []
+
+        for start in range(0, len(pending), block_size):
+            block = pending[start:start + block_size]
+            ratings = user_matrix.rows(block)
+            if isinstance(similarity, TopKSimilarityIndex):
+                product = (ratings @ similarity.neighbours).tocsr()
+                scores = np.full(product.shape, np.nan)
+                rows = np.repeat(np.arange(product.shape[0]), np.diff(product.indptr))
+                scores[rows, product.indices] = product.data
+            else:
+                scores = np.asarray(ratings @ similarity.T)
+
+            # Normalize scores to improve diversity
+            with np.errstate(invalid="ignore"):
+                low = np.nanmin(scores, axis=1, keepdims=True, initial=np.inf, where=~np.isnan(scores))
+                high = np.nanmax(scores, axis=1, keepdims=True, initial=-np.inf, where=~np.isnan(scores))
+                scores = (scores - low) / (high - low + 1e-8)
+            seen_rows = np.repeat(np.arange(ratings.shape[0]), np.diff(ratings.indptr))
+            scores[seen_rows, ratings.indices] = -np.inf
+            scores[np.isnan(scores)] = -np.inf
+
+            top = _top_n(scores, n)
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            for row, (user_id, indices, values) in enumerate(zip(block, top, top_scores)):
+                recommended = [(video_ids[i], float(v)) for i, v in zip(indices, values) if np.isfinite(v)]
+                if recommended and self.cache is not None:
+                    self.cache.put(user_id, n, recommended, token)
+                if not recommended:
+                    seen = ratings.indices[ratings.indptr[row]:ratings.indptr[row + 1]]
+                    recommended = popular.top(n, exclude={video_ids[i] for i in seen})
+                results[user_id] = recommended
+
+        logger.info("Generated batch recommendations for %d users (%d computed)", len(results), len(pending))
+        return {user_id: results[user_id] for user_id in user_ids}
\ No newline at end of file
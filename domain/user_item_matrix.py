@@ -0,0 +1,449 @@
+import logging
+import time
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from domain.entities import ACTIONS, Interaction, InteractionBatch
+
+logger = logging.getLogger(__name__)
+
+_EMPTY_INDICES = np.empty(0, dtype=np.int32)
+_EMPTY_DATA = np.empty(0, dtype=np.float64)
+
+
+class UserItemMatrix:
+    """Неизменяемая разреженная матрица пользователь-элемент на базе scipy.sparse.
+
+    Основное хранилище - CSR-матрица с целочисленными индексами строк и
+    столбцов (словари id -> индекс). Изменённые строки хранятся отдельно
+    в виде пар (indices, data) и периодически сливаются в CSR (compact).
+
+    Методы with_* не меняют объект, а возвращают новую версию: основная
+    CSR-матрица разделяется между версиями, копируются только изменённые
+    строки. Словари пользователей только дополняются и тоже разделяются,
+    а каждая версия видит лишь первые n_users из них, поэтому старые версии
+    можно читать без блокировок, пока единственный писатель строит новые.
+
+    Изменённые строки устроены так же: общий словарь строка -> история
+    состояний (seq, indices, data) только дополняется, а версия видит
+    последнее состояние с seq не больше своего. Поэтому запись стоит
+    O(изменённых строк записи), а не O(всех изменённых строк). Слияние
+    в CSR (O(nnz)) выполняется вне пути записи: compact по более ранней
+    версии и rebase поверх текущей (см. Recommender).
+    """
+
+    def __init__(self, item_ids: Sequence[str], compact_threshold: int = 10000):
+        self.item_ids: List[str] = list(item_ids)
+        self.item_index: Dict[str, int] = {vid: i for i, vid in enumerate(self.item_ids)}
+        self.compact_threshold = compact_threshold
+        self._user_ids: List[str] = []
+        self._user_index: Dict[str, int] = {}
+        self._n_users = 0
+        self._base = sp.csr_matrix((0, len(self.item_ids)), dtype=np.float64)
+        self._start_overlay()
+
+    def _start_overlay(self, dirty: Optional[Dict[int, Tuple[np.ndarray, np.ndarray]]] = None):
+        """Новое поколение изменённых строк (после слияния в CSR или смены столбцов)."""
+        dirty = dirty or {}
+        self._overlay: Dict[int, List[Tuple[int, np.ndarray, np.ndarray]]] = {
+            r: [(0, indices, data)] for r, (indices, data) in dirty.items()
+        }
+        # Общие для поколения: последний выданный seq и номера строк каждой записи
+        self._clock = [0]
+        self._log: List[Sequence[int]] = []
+        self._seq = 0
+        self._n_dirty = len(dirty)
+        self._n_states = len(dirty)
+
+    @classmethod
+    def from_coo(cls, item_ids: Sequence[str], user_ids: Sequence[str], rows: np.ndarray,
+                 cols: np.ndarray, values: np.ndarray, compact_threshold: int = 10000) -> "UserItemMatrix":
+        """Построение матрицы из массивов координат; дубликаты суммируются."""
+        matrix = cls(item_ids, compact_threshold=compact_threshold)
+        matrix._user_ids = list(user_ids)
+        matrix._user_index = {uid: i for i, uid in enumerate(matrix._user_ids)}
+        matrix._n_users = len(matrix._user_ids)
+        base = sp.coo_matrix(
+            (np.asarray(values, dtype=np.float64), (np.asarray(rows), np.asarray(cols))),
+            shape=(matrix._n_users, len(matrix.item_ids))
+        ).tocsr()
+        base.sum_duplicates()
+        matrix._base = base
+        return matrix
+
+    @classmethod
+    def from_csr(cls, item_ids: Sequence[str], user_ids: Sequence[str], base: sp.csr_matrix,
+                 compact_threshold: int = 10000) -> "UserItemMatrix":
+        """Обёртка над готовой CSR-матрицей (в том числе на memmap) без копирования."""
+        matrix = cls(item_ids, compact_threshold=compact_threshold)
+        matrix._user_ids = list(user_ids)
+        matrix._user_index = {uid: i for i, uid in enumerate(matrix._user_ids)}
+        matrix._n_users = len(matrix._user_ids)
+        matrix._base = base
+        return matrix
+
+    @classmethod
+    def from_interactions(cls, item_ids: Sequence[str], interactions: Iterable[Interaction],
+                          score: Callable[[str], float], compact_threshold: int = 10000) -> "UserItemMatrix":
+        """Построение матрицы за один проход по взаимодействиям (O(nnz))."""
+        item_index = {vid: i for i, vid in enumerate(item_ids)}
+        user_index: Dict[str, int] = {}
+        rows, cols, values = [], [], []
+        for interaction in interactions:
+            col = item_index.get(interaction.video_id)
+            if col is None:
+                continue
+            rows.append(user_index.setdefault(interaction.user_id, len(user_index)))
+            cols.append(col)
+            values.append(score(interaction.action))
+        return cls.from_coo(item_ids, list(user_index), np.array(rows, dtype=np.int32),
+                            np.array(cols, dtype=np.int32), np.array(values, dtype=np.float64),
+                            compact_threshold=compact_threshold)
+
+    @property
+    def user_ids(self) -> List[str]:
+        return self._user_ids[:self._n_users]
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self._n_users, len(self.item_ids)
+
+    @property
+    def nnz(self) -> int:
+        base_nnz = self._base.nnz
+        for r, (indices, _) in self._dirty_rows().items():
+            if r < self._base.shape[0]:
+                base_nnz -= self._base.indptr[r + 1] - self._base.indptr[r]
+            base_nnz += len(indices)
+        return int(base_nnz)
+
+    def user_row(self, user_id: str) -> Optional[int]:
+        """Номер строки пользователя в этой версии матрицы или None."""
+        r = self._user_index.get(user_id)
+        if r is None or r >= self._n_users:
+            return None
+        return r
+
+    def __contains__(self, user_id: str) -> bool:
+        return self.user_row(user_id) is not None
+
+    def __len__(self) -> int:
+        return self._n_users
+
+    @property
+    def needs_compaction(self) -> bool:
+        """Изменённых строк (или их состояний) накопилось достаточно для слияния в CSR."""
+        return self._n_dirty >= self.compact_threshold or self._n_states >= 4 * self.compact_threshold
+
+    def _visible(self, r: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        states = self._overlay.get(r)
+        if states:
+            for seq, indices, data in reversed(states):
+                if seq <= self._seq:
+                    return indices, data
+        return None
+
+    def _dirty_rows(self) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+        """Изменённые строки этой версии; O(изменённых строк), для слияния и статистики."""
+        dirty = {}
+        # list() копирует ключи атомарно: писатель может добавлять строки параллельно
+        for r in list(self._overlay):
+            state = self._visible(r)
+            if state is not None:
+                dirty[r] = state
+        return dirty
+
+    def _derive(self, updates: Dict[int, Tuple[np.ndarray, np.ndarray]], n_users: int) -> "UserItemMatrix":
+        source = self
+        if self._seq != self._clock[0]:
+            # Ветка от устаревшей версии: общая история ей не подходит, начинаем новое поколение
+            source = object.__new__(UserItemMatrix)
+            source.__dict__.update(self.__dict__)
+            source._start_overlay(self._dirty_rows())
+        matrix = object.__new__(UserItemMatrix)
+        matrix.__dict__.update(source.__dict__)
+        matrix._n_users = n_users
+        matrix._seq = source._clock[0] + 1
+        matrix._n_dirty += sum(1 for r in updates if source._visible(r) is None)
+        matrix._n_states += len(updates)
+        for r, (indices, data) in updates.items():
+            source._overlay.setdefault(r, []).append((matrix._seq, indices, data))
+        source._log.append(list(updates))
+        source._clock[0] = matrix._seq
+        return matrix
+
+    def _ensure_user(self, user_id: str, n_users: int) -> Tuple[int, int]:
+        """Строка пользователя и новое число пользователей (общие словари только дополняются)."""
+        r = self._user_index.get(user_id)
+        if r is None:
+            r = len(self._user_ids)
+            self._user_ids.append(user_id)
+            self._user_index[user_id] = r
+        return r, max(n_users, r + 1)
+
+    def _row(self, r: int) -> Tuple[np.ndarray, np.ndarray]:
+        dirty = self._visible(r)
+        if dirty is not None:
+            return dirty
+        if r < self._base.shape[0]:
+            start, end = self._base.indptr[r], self._base.indptr[r + 1]
+            return self._base.indices[start:end], self._base.data[start:end]
+        return _EMPTY_INDICES, _EMPTY_DATA
+
+    def row(self, user_id: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Индексы столбцов и значения строки пользователя (без копирования)."""
+        r = self.user_row(user_id)
+        if r is None:
+            return _EMPTY_INDICES, _EMPTY_DATA
+        return self._row(r)
+
+    def rows(self, user_ids: Sequence[str]) -> sp.csr_matrix:
+        """CSR-матрица из строк указанных пользователей (неизвестные - пустые строки)."""
+        parts = [self.row(u) for u in user_ids]
+        indptr = np.zeros(len(parts) + 1, dtype=np.int64)
+        np.cumsum([len(indices) for indices, _ in parts], out=indptr[1:])
+        indices = np.concatenate([p[0] for p in parts]) if parts else _EMPTY_INDICES
+        data = np.concatenate([p[1] for p in parts]) if parts else _EMPTY_DATA
+        return sp.csr_matrix((data, indices, indptr), shape=(len(parts), len(self.item_ids)))
+
+    def dense_row(self, user_id: str) -> np.ndarray:
+        dense = np.zeros(len(self.item_ids), dtype=np.float64)
+        indices, data = self.row(user_id)
+        dense[indices] = data
+        return dense
+
+    def with_value(self, user_id: str, video_id: str, value: float) -> "UserItemMatrix":
+        """Новая версия с прибавленным значением в ячейке (user_id, video_id)."""
+        col = self.item_index[video_id]
+        r, n_users = self._ensure_user(user_id, self._n_users)
+        indices, data = self._row(r)
+        pos = int(np.searchsorted(indices, col))
+        if pos < len(indices) and indices[pos] == col:
+            data = data.copy()
+            data[pos] += value
+        else:
+            indices = np.insert(indices, pos, col).astype(np.int32, copy=False)
+            data = np.insert(data, pos, value)
+        return self._derive({r: (indices, data)}, n_users)
+
+    def with_batch(self, user_ids: Sequence[str], cols: np.ndarray, values: np.ndarray) -> "UserItemMatrix":
+        """Новая версия с прибавленной пачкой значений; каждая затронутая строка сливается один раз."""
+        if not len(user_ids):
+            return self
+        n_users = self._n_users
+        rows = np.empty(len(user_ids), dtype=np.int64)
+        for i, user_id in enumerate(user_ids):
+            rows[i], n_users = self._ensure_user(user_id, n_users)
+        cols = np.asarray(cols, dtype=np.int32)
+        values = np.asarray(values, dtype=np.float64)
+        order = np.argsort(rows, kind="stable")
+        rows, cols, values = rows[order], cols[order], values[order]
+        unique_rows, starts = np.unique(rows, return_index=True)
+        ends = np.append(starts[1:], len(rows))
+        dirty = {}
+        for r, start, end in zip(unique_rows.tolist(), starts.tolist(), ends.tolist()):
+            indices, data = self._row(r)
+            merged, inverse = np.unique(np.concatenate([indices, cols[start:end]]), return_inverse=True)
+            weights = np.concatenate([data, values[start:end]])
+            dirty[r] = (merged.astype(np.int32, copy=False), np.bincount(inverse, weights=weights))
+        return self._derive(dirty, n_users)
+
+    def with_row(self, user_id: str, indices: np.ndarray, data: np.ndarray) -> "UserItemMatrix":
+        """Новая версия с заменённой строкой пользователя; индексы должны быть отсортированы."""
+        r, n_users = self._ensure_user(user_id, self._n_users)
+        return self._derive({r: (np.asarray(indices, dtype=np.int32), np.asarray(data, dtype=np.float64))}, n_users)
+
+    def with_items(self, item_ids: Sequence[str]) -> "UserItemMatrix":
+        """Новая версия с добавленными пустыми столбцами; строки не копируются."""
+        matrix = object.__new__(UserItemMatrix)
+        matrix.__dict__.update(self.__dict__)
+        matrix.item_ids = self.item_ids + list(item_ids)
+        matrix.item_index = {**self.item_index, **{vid: len(self.item_ids) + i for i, vid in enumerate(item_ids)}}
+        base = self._base
+        matrix._base = sp.csr_matrix((base.data, base.indices, base.indptr),
+                                     shape=(base.shape[0], len(matrix.item_ids)))
+        return matrix
+
+    def without_items(self, cols: np.ndarray) -> "UserItemMatrix":
+        """Новая версия без столбцов cols; номера остальных столбцов сдвигаются."""
+        keep = np.ones(len(self.item_ids), dtype=bool)
+        keep[cols] = False
+        remap = np.cumsum(keep) - 1
+        base = self._merged_base()
+        entry_rows = np.repeat(np.arange(base.shape[0]), np.diff(base.indptr))
+        mask = keep[base.indices]
+        indptr = np.zeros(base.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(entry_rows[mask], minlength=base.shape[0]), out=indptr[1:])
+        matrix = object.__new__(UserItemMatrix)
+        matrix.__dict__.update(self.__dict__)
+        matrix.item_ids = [vid for vid, kept in zip(self.item_ids, keep.tolist()) if kept]
+        matrix.item_index = {vid: i for i, vid in enumerate(matrix.item_ids)}
+        matrix._base = sp.csr_matrix(
+            (base.data[mask], remap[base.indices[mask]].astype(np.int32), indptr),
+            shape=(base.shape[0], len(matrix.item_ids))
+        )
+        matrix._start_overlay()
+        return matrix
+
+    def with_users(self, user_ids: Sequence[str]) -> "UserItemMatrix":
+        """Новая матрица только со строками user_ids (неизвестные пропускаются); строки копируются."""
+        user_ids = [u for u in user_ids if u in self]
+        rows = np.array([self._user_index[u] for u in user_ids], dtype=np.int64)
+        return UserItemMatrix.from_csr(self.item_ids, user_ids, self._merged_base()[rows],
+                                       compact_threshold=self.compact_threshold)
+
+    def _merged_base(self) -> sp.csr_matrix:
+        n_users, n_items = self.shape
+        base = self._base
+        src_indptr = np.asarray(base.indptr, dtype=np.int64)
+        if base.shape[0] < n_users:
+            # Новые пользователи - пустые строки в конце, данные base не копируются
+            src_indptr = np.concatenate([src_indptr, np.full(n_users - base.shape[0], src_indptr[-1])])
+        dirty = self._dirty_rows()
+        if not dirty:
+            if base.shape[0] == n_users:
+                return base
+            return sp.csr_matrix((base.data, base.indices, src_indptr), shape=(n_users, n_items))
+        counts = np.diff(src_indptr)
+        dirty_rows = np.sort(np.fromiter(dirty.keys(), dtype=np.int64, count=len(dirty)))
+        counts[dirty_rows] = [len(dirty[r][0]) for r in dirty_rows.tolist()]
+        indptr = np.zeros(n_users + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        data = np.empty(indptr[-1], dtype=np.float64)
+        # Неизменённые строки между изменёнными копируются непрерывными срезами:
+        # копирование срезов отпускает GIL, поэтому фоновое слияние не останавливает писателя
+        start = 0
+        for r in dirty_rows.tolist() + [n_users]:
+            if r > start:
+                src, dst = slice(src_indptr[start], src_indptr[r]), slice(indptr[start], indptr[r])
+                indices[dst] = base.indices[src]
+                data[dst] = base.data[src]
+            if r < n_users:
+                row_indices, row_data = dirty[r]
+                indices[indptr[r]:indptr[r + 1]] = row_indices
+                data[indptr[r]:indptr[r + 1]] = row_data
+            start = r + 1
+        return sp.csr_matrix((data, indices, indptr), shape=(n_users, n_items))
+
+    def compact(self) -> "UserItemMatrix":
+        """Новая версия, в которой изменённые строки слиты в основную CSR-матрицу (O(nnz))."""
+        matrix = object.__new__(UserItemMatrix)
+        matrix.__dict__.update(self.__dict__)
+        matrix._base = self._merged_base()
+        matrix._start_overlay()
+        logger.debug("Compacted user-item matrix: shape=%s, nnz=%d", matrix.shape, matrix._base.nnz)
+        return matrix
+
+    def rebase(self, source: "UserItemMatrix", compacted: "UserItemMatrix") -> "UserItemMatrix":
+        """Перенос этой версии на compacted = source.compact(), где source - её более ранняя версия.
+
+        Переносятся только строки, изменённые после source, поэтому после
+        фонового compact новую версию можно опубликовать под блокировкой
+        писателя за O(записей после source). Если source не предок этой
+        версии (столбцы менялись или уже было слияние), возвращается self.
+        """
+        if (source._overlay is not self._overlay or source.item_ids is not self.item_ids
+                or source._seq > self._seq):
+            return self
+        rows = {r for written in self._log[source._seq:self._seq] for r in written}
+        matrix = object.__new__(UserItemMatrix)
+        matrix.__dict__.update(self.__dict__)
+        matrix._base = compacted._base
+        matrix._start_overlay({r: self._visible(r) for r in rows})
+        logger.debug("Rebased user-item matrix onto compacted base: %d rows changed since", len(rows))
+        return matrix
+
+    def to_csr(self) -> sp.csr_matrix:
+        return self._merged_base()
+
+    def column_sums(self) -> np.ndarray:
+        """Сумма оценок по каждому столбцу (видео)."""
+        csr = self._merged_base()
+        return np.bincount(csr.indices, weights=csr.data, minlength=len(self.item_ids))
+
+    def memory_usage(self) -> int:
+        """Объём памяти (в байтах), занимаемый массивами матрицы."""
+        total = self._base.data.nbytes + self._base.indices.nbytes + self._base.indptr.nbytes
+        for states in list(self._overlay.values()):
+            total += sum(indices.nbytes + data.nbytes for _, indices, data in states)
+        return int(total)
+
+
+def action_scores_by_code(action_weights: Dict[str, float], smoothing_factor: float) -> np.ndarray:
+    """Таблица оценок по коду действия (256 значений, неизвестные - только сглаживание)."""
+    scores = np.full(256, smoothing_factor, dtype=np.float64)
+    for code, action in enumerate(ACTIONS):
+        scores[code] += action_weights.get(action, 0.0)
+    return scores
+
+
+class UserItemMatrixBuilder:
+    """Пошаговое построение матрицы из колоночных порций взаимодействий.
+
+    Идентификаторы переводятся в целочисленные коды, веса действий
+    применяются векторно по кодам действий. Накопленные координаты периодически сворачиваются
+    в CSR (с суммированием дубликатов), поэтому пиковая память ограничена
+    размером итоговой матрицы плюс flush_threshold координат.
+    """
+
+    def __init__(self, item_ids: Sequence[str], action_weights: Dict[str, float], smoothing_factor: float,
+                 flush_threshold: int = 5_000_000):
+        self.item_ids = list(item_ids)
+        self._item_index = pd.Index(self.item_ids)
+        self._scores_by_code = action_scores_by_code(action_weights, smoothing_factor)
+        self.flush_threshold = flush_threshold
+        self._user_index: Dict[str, int] = {}
+        self._parts: List[Tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        self._pending = 0
+        self._csr = sp.csr_matrix((0, len(self.item_ids)), dtype=np.float64)
+        self.rows_seen = 0
+        self.rows_skipped = 0
+        self._started = time.perf_counter()
+
+    def add_chunk(self, batch: InteractionBatch) -> int:
+        """Добавление порции взаимодействий; возвращает число учтённых строк."""
+        self.rows_seen += len(batch)
+        cols = self._item_index.get_indexer(batch.video_ids)
+        known = cols >= 0
+        self.rows_skipped += int((~known).sum())
+
+        user_codes, user_uniques = pd.factorize(batch.user_ids[known])
+        global_codes = np.fromiter(
+            (self._user_index.setdefault(u, len(self._user_index)) for u in user_uniques),
+            dtype=np.int64, count=len(user_uniques)
+        )
+        self._parts.append((
+            global_codes[user_codes],
+            cols[known].astype(np.int32),
+            self._scores_by_code[batch.action_codes[known]]
+        ))
+        self._pending += int(known.sum())
+        if self._pending >= self.flush_threshold:
+            self._flush()
+        logger.info("Loaded %d interactions (%d users, %.0f rows/sec)", self.rows_seen, len(self._user_index),
+                    self.rows_seen / max(time.perf_counter() - self._started, 1e-9))
+        return int(known.sum())
+
+    def _flush(self):
+        if not self._parts:
+            return
+        rows = np.concatenate([p[0] for p in self._parts])
+        cols = np.concatenate([p[1] for p in self._parts])
+        values = np.concatenate([p[2] for p in self._parts])
+        self._parts, self._pending = [], 0
+        shape = (len(self._user_index), len(self.item_ids))
+        partial = sp.coo_matrix((values, (rows, cols)), shape=shape).tocsr()
+        self._csr.resize(shape)
+        self._csr = self._csr + partial
+        logger.debug("Folded interactions into CSR: shape=%s, nnz=%d", shape, self._csr.nnz)
+
+    def build(self, compact_threshold: int = 10000) -> UserItemMatrix:
+        self._flush()
+        self._csr.resize((len(self._user_index), len(self.item_ids)))
+        self._csr.sum_duplicates()
+        if self.rows_skipped:
+            logger.warning("Skipped %d interactions with unknown video_id", self.rows_skipped)
+        return UserItemMatrix.from_csr(self.item_ids, list(self._user_index), self._csr,
+                                       compact_threshold=compact_threshold)
\ No newline at end of file
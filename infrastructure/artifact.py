@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import shutil
+import time
+import numpy as np
+import scipy.sparse as sp
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from domain.cache import RecommendationCache
+from domain.embeddings import EmbeddingIndex
+from domain.entities import Video
+from domain.similarity import TopKSimilarityIndex
+from domain.snapshot import ModelSnapshot
+from domain.use_cases import Recommender
+from domain.user_item_matrix import UserItemMatrix
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+CURRENT_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+
+
+@dataclass(frozen=True)
+class ArtifactState:
+    """Согласованные между собой части модели для экспорта: снимок, видео каталога и популярность."""
+    snapshot: ModelSnapshot
+    videos: Dict[str, Video]
+    popularity: np.ndarray
+    popularity_saved_at: float
+
+
+def capture_artifact_state(recommender: Recommender) -> ArtifactState:
+    """Состояние для save_model_artifact; вызывается в потоке писателя, между обновлениями модели.
+
+    Сам захват дешёвый (ссылки и счётчики популярности), поэтому запись
+    артефакта (O(nnz)) можно выполнять потом, не останавливая писателя.
+    """
+    return ArtifactState(snapshot=recommender.snapshot, videos=recommender.videos,
+                         popularity=recommender.popularity.decayed_scores(), popularity_saved_at=time.time())
+
+
+def _index_dtype(*sizes: int):
+    return np.int32 if max(sizes, default=0) < np.iinfo(np.int32).max else np.int64
+
+
+def _save_csr(directory: str, prefix: str, matrix: sp.csr_matrix):
+    # Одинаковый тип indices и indptr позволяет scipy использовать memmap без копирования
+    dtype = _index_dtype(matrix.nnz, matrix.shape[1])
+    np.save(os.path.join(directory, f"{prefix}_indptr.npy"), matrix.indptr.astype(dtype))
+    np.save(os.path.join(directory, f"{prefix}_indices.npy"), matrix.indices.astype(dtype))
+    np.save(os.path.join(directory, f"{prefix}_data.npy"), matrix.data.astype(np.float64))
+
+
+def _load_csr(directory: str, prefix: str, shape: Tuple[int, int]) -> sp.csr_matrix:
+    arrays = [np.load(os.path.join(directory, f"{prefix}_{name}.npy"), mmap_mode="r")
+              for name in ("data", "indices", "indptr")]
+    return sp.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
+def save_model_artifact(recommender: Recommender, root: str, watermark: int,
+                        state: Optional[ArtifactState] = None) -> str:
+    """Экспорт снимка модели в новую версию артефакта.
+
+    Каждая версия пишется в отдельный каталог, после чего файл CURRENT
+    атомарно переключается на неё; процессы, открывшие старую версию через
+    memmap, продолжают с ней работать. watermark - id последнего учтённого
+    взаимодействия. state - заранее захваченное состояние (по умолчанию -
+    текущее состояние recommender).
+    """
+    state = state or capture_artifact_state(recommender)
+    snapshot = state.snapshot
+    if snapshot.similarity is None:
+        raise ValueError("Video similarity matrix is not initialized")
+
+    version = time.strftime("%Y%m%dT%H%M%S") + f"-{snapshot.version}"
+    directory = os.path.join(root, version)
+    os.makedirs(directory)
+
+    video_ids = snapshot.video_ids
+    user_matrix = snapshot.user_matrix
+    np.save(os.path.join(directory, "video_ids.npy"), np.array(video_ids, dtype=str))
+    np.save(os.path.join(directory, "user_ids.npy"), np.array(user_matrix.user_ids, dtype=str))
+    _save_csr(directory, "user_matrix", user_matrix.to_csr())
+    if isinstance(snapshot.similarity, TopKSimilarityIndex):
+        _save_csr(directory, "neighbours", snapshot.similarity.neighbours)
+    else:
+        np.save(os.path.join(directory, "similarity.npy"), np.ascontiguousarray(snapshot.similarity))
+    embeddings = snapshot.embeddings
+    if embeddings is not None:
+        for name in ("vectors", "ids", "offsets", "centroids"):
+            np.save(os.path.join(directory, f"ivf_{name}.npy"), getattr(embeddings, name))
+    np.save(os.path.join(directory, "popularity.npy"), state.popularity)
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "watermark": watermark,
+        "similarity_mode": recommender.similarity_mode,
+        "top_k": recommender.top_k,
+        "n_videos": len(video_ids),
+        "n_users": len(user_matrix),
+        "videos": [{"id": vid, "genres": state.videos[vid].genres} for vid in video_ids],
+        "popularity_saved_at": state.popularity_saved_at,
+        "embeddings": None if embeddings is None else {
+            "nprobe": embeddings.nprobe,
+            "regularization": embeddings.regularization,
+            "alpha": embeddings.alpha,
+        },
+    }
+    with open(os.path.join(directory, MANIFEST_FILE), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+
+    current_tmp = os.path.join(root, f"{CURRENT_FILE}.{os.getpid()}.tmp")
+    with open(current_tmp, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(current_tmp, os.path.join(root, CURRENT_FILE))
+    logger.info("Saved model artifact %s: %d videos, %d users, watermark %d",
+                directory, len(video_ids), len(user_matrix), watermark)
+    return directory
+
+
+def prune_model_artifacts(root: str, keep: int = 2) -> List[str]:
+    """Удаление старых версий артефакта, кроме keep последних и текущей.
+
+    Процессы, открывшие удалённую версию через memmap, продолжают читать её
+    страницы: файлы освобождаются, когда закрыт последний отображённый массив.
+    """
+    current_path = os.path.join(root, CURRENT_FILE)
+    if not os.path.exists(current_path):
+        return []
+    with open(current_path, encoding="utf-8") as f:
+        current = f.read().strip()
+    versions = sorted(name for name in os.listdir(root)
+                      if os.path.exists(os.path.join(root, name, MANIFEST_FILE)))
+    removed = [name for name in versions[:-keep] if name != current] if keep > 0 else []
+    for name in removed:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    if removed:
+        logger.info("Removed %d old model artifact versions from %s", len(removed), root)
+    return removed
+
+
+def load_model_artifact(root: str, action_weights: Dict[str, float],
+                        cache: Optional[RecommendationCache] = None, **recommender_options) -> Tuple[Recommender, int]:
+    """Загрузка текущей версии артефакта через np.memmap.
+
+    Массивы открываются только для чтения, поэтому несколько процессов
+    разделяют одни и те же страницы. Возвращает рекомендатель и watermark,
+    после которого нужно дочитать взаимодействия из БД. recommender_options
+    передаются в Recommender (например, параметры популярности).
+    """
+    with open(os.path.join(root, CURRENT_FILE), encoding="utf-8") as f:
+        directory = os.path.join(root, f.read().strip())
+    with open(os.path.join(directory, MANIFEST_FILE), encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest["format_version"] != FORMAT_VERSION:
+        raise ValueError(f"Unsupported model artifact version: {manifest['format_version']}")
+
+    videos = [Video(id=v["id"], genres=v["genres"]) for v in manifest["videos"]]
+    recommender = Recommender(
+        videos,
+        action_weights,
+        similarity_mode=manifest["similarity_mode"],
+        top_k=manifest["top_k"],
+        cache=cache,
+        **recommender_options
+    )
+    video_ids = np.load(os.path.join(directory, "video_ids.npy")).tolist()
+    user_ids = np.load(os.path.join(directory, "user_ids.npy")).tolist()
+    n_videos = manifest["n_videos"]
+
+    user_matrix = UserItemMatrix.from_csr(
+        video_ids, user_ids, _load_csr(directory, "user_matrix", (len(user_ids), n_videos))
+    )
+    if manifest["similarity_mode"] == "topk":
+        similarity = TopKSimilarityIndex(_load_csr(directory, "neighbours", (n_videos, n_videos)), manifest["top_k"])
+    else:
+        similarity = np.load(os.path.join(directory, "similarity.npy"), mmap_mode="r")
+    # Артефакты без счётчиков популярности: популярность считается по матрице
+    popularity_path = os.path.join(directory, "popularity.npy")
+    popularity = np.load(popularity_path) if os.path.exists(popularity_path) else None
+    embeddings = None
+    if manifest.get("embeddings"):
+        # Векторы IVF тоже открываются через memmap и разделяются процессами
+        embeddings = EmbeddingIndex(
+            *(np.load(os.path.join(directory, f"ivf_{name}.npy"), mmap_mode="r")
+              for name in ("vectors", "ids", "offsets", "centroids")),
+            **manifest["embeddings"]
+        )
+
+    recommender.install_snapshot(ModelSnapshot(
+        video_ids=video_ids,
+        video_index={vid: i for i, vid in enumerate(video_ids)},
+        user_matrix=user_matrix,
+        similarity=similarity,
+        embeddings=embeddings
+    ), popularity=popularity, popularity_as_of=manifest.get("popularity_saved_at"))
+    logger.info("Loaded model artifact %s: %d videos, %d users, watermark %d",
+                directory, n_videos, len(user_ids), manifest["watermark"])
+    return recommender, manifest["watermark"]
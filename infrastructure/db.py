@@ -1,69 +1,218 @@
 import asyncpg
+import io
+import numpy as np
 import pandas as pd
 import logging
-from typing import List
-from domain.entities import Video, Interaction
+from typing import AsyncIterator, List, Optional, Tuple, Union
+from domain.entities import Video, Interaction, InteractionBatch
+from domain.metrics import REGISTRY, timed
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DB_QUERY_SECONDS = REGISTRY.histogram("db_query_seconds", "Time spent in repository database calls", ["query"])
+
 class VideoRepository:
     def __init__(self, pool: asyncpg.Pool):
         self.pool = pool
 
+    @timed(DB_QUERY_SECONDS.labels("get_all_videos"))
     async def get_all_videos(self) -> List[Video]:
         async with self.pool.acquire() as conn:
             rows = await conn.fetch("SELECT id, genres FROM videos")
             videos = [Video(id=row["id"], genres=row["genres"]) for row in rows]
-            logger.info(f"Retrieved {len(videos)} videos from database")
+            logger.info("Retrieved %d videos from database", len(videos))
             return videos
 
+    @timed(DB_QUERY_SECONDS.labels("get_similarity_pairs"))
+    async def get_similarity_pairs(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Загрузка пар схожести через COPY сразу в массивы NumPy."""
+        buffer = io.BytesIO()
+        async with self.pool.acquire() as conn:
+            await conn.copy_from_query(
+                "SELECT video1_id, video2_id, similarity FROM video_similarity",
+                output=buffer,
+                format="csv"
+            )
+        buffer.seek(0)
+        frame = pd.read_csv(
+            buffer,
+            header=None,
+            names=["video1_id", "video2_id", "similarity"],
+            dtype={"video1_id": str, "video2_id": str, "similarity": np.float64},
+            keep_default_na=False
+        )
+        logger.info("Retrieved %d similarity pairs from database", len(frame))
+        return (
+            frame["video1_id"].to_numpy(dtype=object),
+            frame["video2_id"].to_numpy(dtype=object),
+            frame["similarity"].to_numpy()
+        )
+
     async def get_similarity_matrix(self) -> pd.DataFrame:
         async with self.pool.acquire() as conn:
             schema = await conn.fetch("SELECT column_name FROM information_schema.columns WHERE table_name = 'video_similarity'")
             columns = [row["column_name"] for row in schema]
-            logger.info(f"Columns in video_similarity table: {columns}")
-            rows = await conn.fetch("SELECT video1_id, video2_id, similarity FROM video_similarity")
-        if not rows:
+            logger.info("Columns in video_similarity table: %s", columns)
+        v1, v2, similarity = await self.get_similarity_pairs()
+        if not len(similarity):
             logger.warning("No similarity data found")
             return pd.DataFrame()
-        data = {(r["video1_id"], r["video2_id"]): r["similarity"] for r in rows}
-        video_ids = sorted(set(r["video1_id"] for r in rows) | set(r["video2_id"] for r in rows))
-        matrix = pd.DataFrame(0.0, index=video_ids, columns=video_ids)
-        for (v1, v2), sim in data.items():
-            matrix.loc[v1, v2] = sim
-            matrix.loc[v2, v1] = sim
+        video_ids, codes = np.unique(np.concatenate([v1, v2]), return_inverse=True)
+        rows, cols = codes[:len(v1)], codes[len(v1):]
+        values = np.zeros((len(video_ids), len(video_ids)), dtype=np.float64)
+        values[rows, cols] = similarity
+        values[cols, rows] = similarity
         logger.debug("Loaded similarity matrix")
-        return matrix
+        return pd.DataFrame(values, index=video_ids, columns=video_ids)
 
-    async def save_similarity_matrix(self, matrix: pd.DataFrame):
+    @timed(DB_QUERY_SECONDS.labels("upsert_videos"))
+    async def upsert_videos(self, videos: List[Video]):
+        """Добавление или обновление жанров видео."""
+        async with self.pool.acquire() as conn:
+            await conn.executemany(
+                "INSERT INTO videos (id, genres) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET genres = EXCLUDED.genres",
+                [(v.id, v.genres) for v in videos]
+            )
+        logger.debug("Upserted %d videos", len(videos))
+
+    @timed(DB_QUERY_SECONDS.labels("delete_videos"))
+    async def delete_videos(self, video_ids: List[str]):
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM videos WHERE id = ANY($1::text[])", list(video_ids))
+        logger.debug("Deleted %d videos", len(video_ids))
+
+    @timed(DB_QUERY_SECONDS.labels("replace_similarity_pairs_for"))
+    async def replace_similarity_pairs_for(self, video_ids: List[str], video1_ids: np.ndarray,
+                                           video2_ids: np.ndarray, similarity: np.ndarray):
+        """Замена только тех пар схожести, в которых участвуют video_ids.
+
+        Старые пары этих видео удаляются, новые записываются через COPY в той
+        же транзакции; остальные строки таблицы не затрагиваются.
+        """
+        records = zip(
+            np.asarray(video1_ids).tolist(),
+            np.asarray(video2_ids).tolist(),
+            np.asarray(similarity, dtype=np.float64).tolist()
+        )
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    "DELETE FROM video_similarity WHERE video1_id = ANY($1::text[]) OR video2_id = ANY($1::text[])",
+                    list(video_ids)
+                )
+                await conn.copy_records_to_table(
+                    "video_similarity",
+                    records=records,
+                    columns=["video1_id", "video2_id", "similarity"]
+                )
+        logger.debug("Replaced similarity pairs of %d videos with %d pairs", len(video_ids), len(similarity))
+
+    @timed(DB_QUERY_SECONDS.labels("save_similarity_pairs"))
+    async def save_similarity_pairs(self, video1_ids: np.ndarray, video2_ids: np.ndarray, similarity: np.ndarray):
+        """Полная замена таблицы схожести одним COPY."""
+        records = zip(
+            np.asarray(video1_ids).tolist(),
+            np.asarray(video2_ids).tolist(),
+            np.asarray(similarity, dtype=np.float64).tolist()
+        )
         async with self.pool.acquire() as conn:
             async with conn.transaction():
                 await conn.execute("DELETE FROM video_similarity")
-                for v1 in matrix.index:
-                    for v2 in matrix.columns:
-                        if v1 <= v2 and matrix.loc[v1, v2] > 0:
-                            await conn.execute(
-                                "INSERT INTO video_similarity (video1_id, video2_id, similarity) VALUES ($1, $2, $3)",
-                                v1, v2, float(matrix.loc[v1, v2])
-                            )
-            logger.debug("Saved similarity matrix")
+                await conn.copy_records_to_table(
+                    "video_similarity",
+                    records=records,
+                    columns=["video1_id", "video2_id", "similarity"]
+                )
+        logger.debug("Saved %d similarity pairs", len(similarity))
+
+    async def save_similarity_matrix(self, matrix: pd.DataFrame):
+        values = matrix.to_numpy(dtype=np.float64)
+        rows, cols = np.nonzero(values > 0)
+        index = matrix.index.to_numpy(dtype=object)
+        columns = matrix.columns.to_numpy(dtype=object)
+        keep = index[rows] <= columns[cols]
+        rows, cols = rows[keep], cols[keep]
+        await self.save_similarity_pairs(index[rows], columns[cols], values[rows, cols])
+        logger.debug("Saved similarity matrix")
 
 class InteractionRepository:
     def __init__(self, pool: asyncpg.Pool):
         self.pool = pool
 
-    async def get_all_interactions(self) -> List[Interaction]:
+    @timed(DB_QUERY_SECONDS.labels("get_interaction_watermark"))
+    async def get_interaction_watermark(self) -> int:
+        """Наибольший id взаимодействия (граница для артефакта модели)."""
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("SELECT COALESCE(MAX(id), 0) FROM interactions")
+
+    @timed(DB_QUERY_SECONDS.labels("get_interactions_since"))
+    async def get_interactions_since(self, watermark: int) -> Tuple[InteractionBatch, int]:
+        """Взаимодействия с id больше watermark и новый watermark."""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT id, user_id, video_id, action FROM interactions WHERE id > $1 ORDER BY id",
+                watermark
+            )
+        interactions = InteractionBatch.from_columns(
+            [row["user_id"] for row in rows], [row["video_id"] for row in rows], [row["action"] for row in rows]
+        )
+        logger.info("Retrieved %d interactions after watermark %d", len(interactions), watermark)
+        return interactions, (rows[-1]["id"] if rows else watermark)
+
+    async def iter_interaction_chunks(self, chunk_size: int = 100_000, max_id: Optional[int] = None
+                                      ) -> AsyncIterator[InteractionBatch]:
+        """Потоковое чтение взаимодействий через серверный курсор.
+
+        Возвращает порции в колоночном виде (InteractionBatch), не создавая
+        объект Interaction на каждую строку.
+        """
+        query = "SELECT user_id, video_id, action FROM interactions"
+        args = []
+        if max_id is not None:
+            query += " WHERE id <= $1"
+            args.append(max_id)
         async with self.pool.acquire() as conn:
-            rows = await conn.fetch("SELECT user_id, video_id, action FROM interactions")
+            async with conn.transaction():
+                cursor = await conn.cursor(query, *args, prefetch=chunk_size)
+                while True:
+                    with DB_QUERY_SECONDS.labels("iter_interaction_chunks").time():
+                        rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        break
+                    logger.debug("Fetched chunk of %d interactions", len(rows))
+                    yield InteractionBatch.from_columns(*zip(*rows))
+
+    @timed(DB_QUERY_SECONDS.labels("get_all_interactions"))
+    async def get_all_interactions(self, max_id: Optional[int] = None) -> List[Interaction]:
+        async with self.pool.acquire() as conn:
+            if max_id is None:
+                rows = await conn.fetch("SELECT user_id, video_id, action FROM interactions")
+            else:
+                rows = await conn.fetch("SELECT user_id, video_id, action FROM interactions WHERE id <= $1", max_id)
             interactions = [Interaction(user_id=row["user_id"], video_id=row["video_id"], action=row["action"]) for row in rows]
-            logger.debug(f"Retrieved {len(interactions)} interactions")
+            logger.debug("Retrieved %d interactions", len(interactions))
             return interactions
 
+    @timed(DB_QUERY_SECONDS.labels("save_interaction"))
     async def save_interaction(self, interaction: Interaction):
         async with self.pool.acquire() as conn:
             await conn.execute(
                 "INSERT INTO interactions (user_id, video_id, action) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING",
                 interaction.user_id, interaction.video_id, interaction.action
             )
-            logger.debug(f"Saved interaction: {interaction.user_id}, {interaction.video_id}, {interaction.action})")
\ No newline at end of file
+            logger.debug("Saved interaction: %s, %s, %s", interaction.user_id, interaction.video_id, interaction.action)
+
+    @timed(DB_QUERY_SECONDS.labels("save_interactions"))
+    async def save_interactions(self, interactions: Union[List[Interaction], InteractionBatch]):
+        """Сохранение пачки взаимодействий одним executemany."""
+        if isinstance(interactions, InteractionBatch):
+            records = zip(interactions.user_ids.tolist(), interactions.video_ids.tolist(), interactions.actions)
+        else:
+            records = [(i.user_id, i.video_id, i.action) for i in interactions]
+        async with self.pool.acquire() as conn:
+            await conn.executemany(
+                "INSERT INTO interactions (user_id, video_id, action) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING",
+                records
+            )
+            logger.debug("Saved %d interactions", len(interactions))
\ No newline at end of file
@@ -0,0 +1,69 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class RecommenderExecutor:
+    """Выполнение работы рекомендателя прямо в event loop (без выноса).
+
+    Задачи делятся на три вида: read - чтение (recommend), write - изменение
+    модели (применение взаимодействий), rebuild - полная перестройка.
+    """
+
+    async def read(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return fn(*args, **kwargs)
+
+    async def write(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return fn(*args, **kwargs)
+
+    async def rebuild(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return fn(*args, **kwargs)
+
+    def shutdown(self):
+        pass
+
+
+class PooledRecommenderExecutor(RecommenderExecutor):
+    """Вынос CPU-нагрузки из event loop.
+
+    Чтения выполняются в пуле потоков (NumPy отпускает GIL), изменения - в
+    одном выделенном потоке, чтобы обновления модели шли строго по очереди,
+    перестройки - в пуле процессов (fn и аргументы должны сериализоваться).
+    """
+
+    def __init__(self, read_workers: int = 4, rebuild_workers: int = 1, use_processes: bool = True):
+        self._read_pool = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix="recommender-read")
+        self._write_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recommender-write")
+        self._rebuild_pool: Optional[Executor] = None
+        if use_processes:
+            self._rebuild_pool = ProcessPoolExecutor(
+                max_workers=rebuild_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        logger.info("Recommender executor started: %d read threads, rebuilds in %s",
+                    read_workers, "processes" if use_processes else "the write thread")
+
+    @staticmethod
+    async def _run(pool: Executor, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pool, functools.partial(fn, *args, **kwargs))
+
+    async def read(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return await self._run(self._read_pool, fn, *args, **kwargs)
+
+    async def write(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return await self._run(self._write_pool, fn, *args, **kwargs)
+
+    async def rebuild(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return await self._run(self._rebuild_pool or self._write_pool, fn, *args, **kwargs)
+
+    def shutdown(self):
+        self._read_pool.shutdown(wait=False)
+        self._write_pool.shutdown(wait=True)
+        if self._rebuild_pool is not None:
+            self._rebuild_pool.shutdown(wait=False, cancel_futures=True)
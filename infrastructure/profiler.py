@@ -0,0 +1,69 @@
+import collections
+import logging
+import sys
+import threading
+from typing import Counter, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SamplingProfiler:
+    """Семплирующий профилировщик всех потоков процесса.
+
+    Фоновый поток раз в interval секунд снимает стеки через
+    sys._current_frames() и считает одинаковые стеки. Результат - формат
+    collapsed stacks ("f1;f2;f3 count"), который понимают flamegraph.pl и
+    speedscope. Работающий код не инструментируется, поэтому накладные
+    расходы определяются только частотой выборки.
+    """
+
+    def __init__(self, interval: float = 0.01, max_depth: int = 64):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self._stacks: Counter[str] = collections.Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logger.info("Sampling profiler started, interval %.1f ms", self.interval * 1000)
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        logger.info("Sampling profiler stopped after %d samples", self.samples)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self._stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self._stacks.most_common()) + "\n"
+
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.collapsed())
+        logger.info("Wrote %d profiler samples to %s", self.samples, path)
+
@@ -1,22 +1,110 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from domain.metrics import REGISTRY
 from domain.use_cases import Recommender
+from infrastructure.executor import RecommenderExecutor
 import logging
+import time
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "http_request_seconds", "HTTP request latency by route", ["method", "route", "status"]
+)
+MODEL_USERS = REGISTRY.gauge("recommender_users", "Users in the current user-item matrix")
+MODEL_VIDEOS = REGISTRY.gauge("recommender_videos", "Videos in the current model snapshot")
+MODEL_VERSION = REGISTRY.gauge("recommender_snapshot_version", "Version of the current model snapshot")
+CACHE_STATS = REGISTRY.gauge("recommendation_cache", "Recommendation cache counters", ["stat"])
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # Шаблон маршрута, а не путь: иначе каждый user_id станет отдельной серией
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    HTTP_REQUEST_SECONDS.labels(request.method, route, str(response.status_code)).observe(
+        time.perf_counter() - started
+    )
+    return response
+
+def get_executor() -> RecommenderExecutor:
+    return getattr(app.state, "executor", None) or RecommenderExecutor()
+
+class BatchRecommendationRequest(BaseModel):
+    user_ids: List[str] = Field(..., max_length=10000)
+    n: int = Field(3, ge=1, le=100)
+
 @app.get("/recommendations/{user_id}")
 async def get_recommendations(
     user_id: str,
-    recommender: Recommender = Depends(lambda: app.state.recommender)
+    response: Response,
+    recommender: Recommender = Depends(lambda: app.state.recommender),
+    executor: RecommenderExecutor = Depends(get_executor)
 ):
-    """Получение рекомендаций для указанного пользователя."""
-    logger.info(f"Received request for recommendations for user_id: {user_id}")
-    recommendations = recommender.recommend(user_id)
+    """Получение рекомендаций для указанного пользователя.
+
+    Заголовок X-Recommendation-Tier: popular для новых и холодных
+    пользователей (и когда модель не нашла кандидатов), personal для
+    рекомендаций по модели.
+    """
+    logger.debug("Received request for recommendations for user_id: %s", user_id)
+    recommendations, tier = await executor.read(recommender.recommend_with_tier, user_id)
     if not recommendations:
-        logger.warning(f"No recommendations available for user_id: {user_id}")
+        logger.warning("No recommendations available for user_id: %s", user_id)
         raise HTTPException(status_code=404, detail="No recommendations available")
-    logger.info(f"Returning recommendations: {recommendations}")
-    return [{"video_id": vid, "score": score} for vid, score in recommendations]
\ No newline at end of file
+    response.headers["X-Recommendation-Tier"] = tier
+    logger.debug("Returning recommendations: %s", recommendations)
+    return [{"video_id": vid, "score": score} for vid, score in recommendations]
+
+@app.post("/recommendations/batch")
+async def get_batch_recommendations(
+    request: BatchRecommendationRequest,
+    recommender: Recommender = Depends(lambda: app.state.recommender),
+    executor: RecommenderExecutor = Depends(get_executor)
+):
+    """Получение рекомендаций для списка пользователей одним запросом."""
+    logger.debug("Received batch request for %d users", len(request.user_ids))
+    recommendations = await executor.read(recommender.recommend_batch, request.user_ids, request.n)
+    return {
+        user_id: [{"video_id": vid, "score": score} for vid, score in items]
+        for user_id, items in recommendations.items()
+    }
+
+@app.get("/popular")
+async def get_popular(
+    n: int = Query(10, ge=1, le=1000),
+    genre: Optional[str] = None,
+    recommender: Recommender = Depends(lambda: app.state.recommender),
+    executor: RecommenderExecutor = Depends(get_executor)
+):
+    """Самые популярные видео за последнее время, при необходимости одного жанра."""
+    popular = await executor.read(recommender.popular, n, genre)
+    if not popular:
+        raise HTTPException(status_code=404, detail="No popular videos available")
+    return [{"video_id": vid, "score": score} for vid, score in popular]
+
+@app.get("/cache/stats")
+async def get_cache_stats(recommender: Recommender = Depends(lambda: app.state.recommender)):
+    """Счётчики кэша рекомендаций: попадания, промахи, вытеснения."""
+    if recommender.cache is None:
+        raise HTTPException(status_code=404, detail="Recommendation cache is disabled")
+    return recommender.cache.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Метрики процесса в текстовом формате Prometheus."""
+    recommender = getattr(app.state, "recommender", None)
+    if recommender is not None:
+        snapshot = recommender.snapshot
+        MODEL_USERS.set(len(snapshot.user_matrix))
+        MODEL_VIDEOS.set(len(snapshot.video_ids))
+        MODEL_VERSION.set(snapshot.version)
+        if recommender.cache is not None:
+            for stat, value in recommender.cache.stats().items():
+                CACHE_STATS.labels(stat).set(value)
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
@@ -1,44 +1,266 @@
 import aio_pika
-from domain.entities import Interaction
+from domain.entities import Interaction, InteractionBatch, Video
+from domain.metrics import REGISTRY
 from domain.use_cases import Recommender
-from infrastructure.db import InteractionRepository
+from infrastructure.db import InteractionRepository, VideoRepository
+from infrastructure.executor import RecommenderExecutor
+import contextlib
 import json
 import logging
 import asyncio
+import time
+from typing import List, Optional
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-async def consume_interactions(queue: aio_pika.Queue, recommender: Recommender, interaction_repo: InteractionRepository):
+MESSAGE_SECONDS = REGISTRY.histogram("consumer_message_seconds", "Time to process one interaction message")
+BATCH_SECONDS = REGISTRY.histogram("consumer_batch_seconds", "Time to process one batch of interaction messages")
+BATCH_SIZE = REGISTRY.histogram(
+    "consumer_batch_size", "Messages per processed batch", buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+MESSAGES = REGISTRY.counter("consumer_messages_total", "Consumed interaction messages", ["outcome"])
+CATALOG_EVENTS = REGISTRY.counter("consumer_catalog_events_total", "Consumed video catalog events", ["op"])
+
+CATALOG_UPSERT = "upsert"
+CATALOG_DELETE = "delete"
+
+async def consume_interactions(queue: aio_pika.Queue, recommender: Recommender, interaction_repo: InteractionRepository,
+                               executor: Optional[RecommenderExecutor] = None, pause: Optional[asyncio.Lock] = None):
+    """Потребление по одному сообщению; pause приостанавливает запись и применение (экспорт артефакта)."""
+    executor = executor or RecommenderExecutor()
+    pause = pause or contextlib.nullcontext()
     logger.info("Starting RabbitMQ consumer...")
     while True:
         try:
             async for message in queue:
                 async with message.process(ignore_processed=True):
+                    started = time.perf_counter()
                     try:
                         body = message.body.decode()
-                        logger.debug(f"Received message: {body}")
+                        logger.debug("Received message: %s", body)
                         data = json.loads(body)
                         interaction = Interaction(
                             user_id=data["user_id"],
                             video_id=data["video_id"],
                             action=data["action"],
                         )
-                        logger.info(f"Processing interaction: {interaction}")
-                        await interaction_repo.save_interaction(interaction)
-                        interactions = await interaction_repo.get_all_interactions()
-                        logger.info(f"Updating user-item matrix for user {interaction.user_id}")
-                        recommender.update_user_item_matrix(interactions, user_id=interaction.user_id)
-                        recommendations = recommender.recommend(interaction.user_id)
-                        logger.debug(f"Recommendations for {interaction.user_id}: {recommendations}")
+                        logger.debug("Processing interaction: %s", interaction)
+                        async with pause:
+                            await interaction_repo.save_interaction(interaction)
+                            await executor.write(recommender.apply_interaction, interaction)
+                        if logger.isEnabledFor(logging.DEBUG):
+                            # Рекомендации считаются только ради отладочного вывода
+                            recommendations = await executor.read(recommender.recommend, interaction.user_id)
+                            logger.debug("Recommendations for %s: %s", interaction.user_id, recommendations)
                         await message.ack()
+                        MESSAGE_SECONDS.observe(time.perf_counter() - started)
+                        MESSAGES.labels("ack").inc()
                     except Exception as e:
                         logger.error(f"Error processing message: {e}", exc_info=True)
                         await message.nack(requeue=True)
+                        MESSAGES.labels("requeued").inc()
                         await asyncio.sleep(1)
         except (aio_pika.exceptions.AMQPConnectionError, asyncio.CancelledError) as e:
             logger.warning(f"Consumer interrupted: {e}; reconnecting in 5 seconds...")
             await asyncio.sleep(5)
         except Exception as e:
             logger.error(f"Unexpected consumer error: {e}", exc_info=True)
-            await asyncio.sleep(5)
\ No newline at end of file
+            await asyncio.sleep(5)
+
+class _BatchCollector:
+    """Сбор пачек из итератора очереди: до batch_size сообщений или linger_ms после первого.
+
+    Ожидание следующего сообщения по таймеру не отменяется, а переносится
+    в следующую пачку: отмена __anext__ у aio-pika закрывает итератор
+    (Basic.cancel, nack буфера), а повторное закрытие падает с KeyError.
+    """
+
+    def __init__(self, messages: aio_pika.abc.AbstractQueueIterator):
+        self.messages = messages
+        self._next: Optional[asyncio.Future] = None
+
+    async def _take(self, timeout: Optional[float] = None) -> Optional[aio_pika.abc.AbstractIncomingMessage]:
+        """Следующее сообщение или None, если за timeout оно не пришло."""
+        if self._next is None:
+            self._next = asyncio.ensure_future(self.messages.__anext__())
+        done, _ = await asyncio.wait({self._next}, timeout=timeout)
+        if not done:
+            return None
+        task, self._next = self._next, None
+        return task.result()
+
+    async def collect(self, batch_size: int, linger_ms: float) -> List[aio_pika.abc.AbstractIncomingMessage]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._take()]
+        deadline = loop.time() + linger_ms / 1000
+        while len(batch) < batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            message = await self._take(timeout)
+            if message is None:
+                break
+            batch.append(message)
+        return batch
+
+    async def close(self):
+        """Отмена незавершённого ожидания перед закрытием итератора."""
+        task, self._next = self._next, None
+        if task is not None and not task.done():
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await task
+
+def _parse_interaction(body: bytes):
+    """Поля взаимодействия из сообщения {"user_id": ..., "video_id": ..., "action": ...}."""
+    data = json.loads(body.decode())
+    if not isinstance(data, dict):
+        raise ValueError(f"Interaction message must be a JSON object, got {type(data).__name__}")
+    fields = data["user_id"], data["video_id"], data["action"]
+    if not all(isinstance(field, str) for field in fields):
+        raise ValueError("Interaction user_id, video_id and action must be strings")
+    return fields
+
+async def _process_batch(batch: List[aio_pika.abc.AbstractIncomingMessage], recommender: Recommender,
+                         interaction_repo: InteractionRepository, executor: RecommenderExecutor,
+                         pause: Optional[asyncio.Lock] = None):
+    user_ids, video_ids, actions, pending = [], [], [], []
+    for message in batch:
+        try:
+            user_id, video_id, action = _parse_interaction(message.body)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Dropping malformed message: {e}")
+            await message.reject(requeue=False)
+            MESSAGES.labels("rejected").inc()
+            continue
+        user_ids.append(user_id)
+        video_ids.append(video_id)
+        actions.append(action)
+        pending.append(message)
+
+    if not pending:
+        return
+    BATCH_SIZE.observe(len(pending))
+    try:
+        with BATCH_SECONDS.time():
+            interactions = InteractionBatch.from_columns(user_ids, video_ids, actions)
+            # Сохранение и применение не разделяются экспортом артефакта: его watermark точен
+            async with pause or contextlib.nullcontext():
+                await interaction_repo.save_interactions(interactions)
+                await executor.write(recommender.apply_interactions, interactions)
+            # Подтверждение последнего сообщения подтверждает всю пачку
+            await pending[-1].ack(multiple=True)
+        MESSAGES.labels("ack").inc(len(pending))
+        logger.debug("Processed batch of %d interactions", len(interactions))
+    except Exception as e:
+        logger.error(f"Error processing batch of {len(batch)} messages: {e}", exc_info=True)
+        await pending[-1].nack(multiple=True, requeue=True)
+        MESSAGES.labels("requeued").inc(len(pending))
+        await asyncio.sleep(1)
+
+async def consume_interaction_batches(queue: aio_pika.Queue, recommender: Recommender,
+                                      interaction_repo: InteractionRepository, batch_size: int = 100,
+                                      linger_ms: float = 50, executor: Optional[RecommenderExecutor] = None,
+                                      pause: Optional[asyncio.Lock] = None):
+    """Потребление сообщений пачками: одна запись в БД, одно обновление матрицы и один ack на пачку."""
+    executor = executor or RecommenderExecutor()
+    pause = pause or contextlib.nullcontext()
+    logger.info("Starting batching RabbitMQ consumer (batch_size=%d, linger_ms=%s)...", batch_size, linger_ms)
+    while True:
+        try:
+            async with queue.iterator() as messages:
+                batches = _BatchCollector(messages)
+                try:
+                    while True:
+                        batch = await batches.collect(batch_size, linger_ms)
+                        await _process_batch(batch, recommender, interaction_repo, executor, pause)
+                finally:
+                    await batches.close()
+        except (aio_pika.exceptions.AMQPConnectionError, asyncio.CancelledError) as e:
+            logger.warning(f"Consumer interrupted: {e}; reconnecting in 5 seconds...")
+            await asyncio.sleep(5)
+        except Exception as e:
+            logger.error(f"Unexpected consumer error: {e}", exc_info=True)
+            await asyncio.sleep(5)
+
+def _parse_catalog_event(body: bytes):
+    """Событие каталога: {"op": "upsert", "id": ..., "genres": [...]} или {"op": "delete", "id": ...}."""
+    data = json.loads(body.decode())
+    op, video_id = data["op"], data["id"]
+    if op == CATALOG_UPSERT:
+        return op, Video(id=video_id, genres=list(data.get("genres") or []))
+    if op == CATALOG_DELETE:
+        return op, video_id
+    raise ValueError(f"Unknown catalog operation: {op}")
+
+async def _process_catalog_batch(batch: List[aio_pika.abc.AbstractIncomingMessage], recommender: Recommender,
+                                 video_repo: VideoRepository, executor: RecommenderExecutor, persist: bool = True):
+    events, pending = [], []
+    for message in batch:
+        try:
+            events.append(_parse_catalog_event(message.body))
+            pending.append(message)
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error(f"Dropping malformed catalog event: {e}")
+            await message.reject(requeue=False)
+    if not pending:
+        return
+
+    # Подряд идущие события одного типа применяются одним вызовом, порядок событий сохраняется
+    runs = []
+    for op, payload in events:
+        if runs and runs[-1][0] == op:
+            runs[-1][1].append(payload)
+        else:
+            runs.append((op, [payload]))
+    try:
+        affected = set()
+        for op, payloads in runs:
+            if op == CATALOG_UPSERT:
+                if persist:
+                    await video_repo.upsert_videos(payloads)
+                affected.update(await executor.write(recommender.upsert_videos, payloads))
+            else:
+                if persist:
+                    await video_repo.delete_videos(payloads)
+                affected.update(await executor.write(recommender.remove_videos, payloads))
+            CATALOG_EVENTS.labels(op).inc(len(payloads))
+        if persist and affected and recommender.snapshot.similarity is not None:
+            pairs = await executor.read(recommender.similarity_pairs, list(affected))
+            await video_repo.replace_similarity_pairs_for(list(affected), *pairs)
+        await pending[-1].ack(multiple=True)
+        logger.info("Applied %d catalog events, similarity of %d videos updated", len(events), len(affected))
+    except Exception as e:
+        logger.error(f"Error processing batch of {len(batch)} catalog events: {e}", exc_info=True)
+        await pending[-1].nack(multiple=True, requeue=True)
+        await asyncio.sleep(1)
+
+async def consume_catalog_events(queue: aio_pika.Queue, recommender: Recommender, video_repo: VideoRepository,
+                                 executor: Optional[RecommenderExecutor] = None, batch_size: int = 100,
+                                 linger_ms: float = 200, persist: bool = True):
+    """Применение событий каталога видео без перезапуска сервиса.
+
+    Видео сохраняются в таблицу videos, модель обновляется инкрементально,
+    а в video_similarity переписываются только пары затронутых видео.
+    События получает каждый шард, а в БД их пишет только один (persist):
+    остальные лишь обновляют модель в памяти.
+    """
+    executor = executor or RecommenderExecutor()
+    logger.info("Starting video catalog consumer...")
+    while True:
+        try:
+            async with queue.iterator() as messages:
+                batches = _BatchCollector(messages)
+                try:
+                    while True:
+                        batch = await batches.collect(batch_size, linger_ms)
+                        await _process_catalog_batch(batch, recommender, video_repo, executor, persist)
+                finally:
+                    await batches.close()
+        except (aio_pika.exceptions.AMQPConnectionError, asyncio.CancelledError) as e:
+            logger.warning(f"Catalog consumer interrupted: {e}; reconnecting in 5 seconds...")
+            await asyncio.sleep(5)
+        except Exception as e:
+            logger.error(f"Unexpected catalog consumer error: {e}", exc_info=True)
+            await asyncio.sleep(5)
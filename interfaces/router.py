@@ -0,0 +1,104 @@
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse
+from typing import Dict, List, Optional
+from urllib.parse import quote
+from domain.metrics import REGISTRY
+from domain.sharding import partition, shard_of
+from interfaces.api import BatchRecommendationRequest
+import asyncio
+import httpx
+import logging
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+UPSTREAM_SECONDS = REGISTRY.histogram("router_upstream_seconds", "Shard API request latency", ["shard"])
+
+router_app = FastAPI()
+
+
+class ShardRouter:
+    """Маршрутизация запросов API к процессу, владеющему шардом пользователя.
+
+    Шард, который применяет взаимодействия пользователя, сам отвечает на
+    его запросы рекомендаций, поэтому чтение видит все уже применённые
+    обновления этого пользователя (как в одном процессе).
+    """
+
+    def __init__(self, shard_urls: List[str], client: Optional[httpx.AsyncClient] = None):
+        if not shard_urls:
+            raise ValueError("No shard URLs configured")
+        self.shard_urls = [url.rstrip("/") for url in shard_urls]
+        self.client = client or httpx.AsyncClient(timeout=10.0)
+
+    @property
+    def shards(self) -> int:
+        return len(self.shard_urls)
+
+    async def request(self, shard: int, method: str, path: str, **kwargs) -> httpx.Response:
+        started = time.perf_counter()
+        try:
+            return await self.client.request(method, self.shard_urls[shard] + path, **kwargs)
+        finally:
+            UPSTREAM_SECONDS.labels(str(shard)).observe(time.perf_counter() - started)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def get_router() -> ShardRouter:
+    return router_app.state.shard_router
+
+
+def _proxy(upstream: httpx.Response) -> Response:
+    headers = {name: value for name, value in upstream.headers.items() if name.lower().startswith("x-")}
+    return Response(upstream.content, status_code=upstream.status_code, headers=headers,
+                    media_type=upstream.headers.get("content-type"))
+
+
+@router_app.get("/recommendations/{user_id}")
+async def route_recommendations(user_id: str):
+    """Рекомендации от шарда пользователя."""
+    router = get_router()
+    # user_id уже раскодирован: без повторного кодирования "?", "#" и "%" изменили бы запрос к шарду
+    path = f"/recommendations/{quote(user_id, safe='')}"
+    return _proxy(await router.request(shard_of(user_id, router.shards), "GET", path))
+
+
+@router_app.post("/recommendations/batch")
+async def route_batch_recommendations(request: BatchRecommendationRequest):
+    """Пакетный запрос делится по шардам, части выполняются параллельно."""
+    router = get_router()
+    parts = partition(list(dict.fromkeys(request.user_ids)), router.shards)
+
+    async def fetch(shard: int, user_ids: List[str]) -> Dict[str, list]:
+        response = await router.request(shard, "POST", "/recommendations/batch",
+                                        json={"user_ids": user_ids, "n": request.n})
+        if response.status_code != 200:
+            raise HTTPException(status_code=502, detail=f"Shard {shard} returned {response.status_code}")
+        return response.json()
+
+    results: Dict[str, list] = {}
+    for part in await asyncio.gather(*(fetch(shard, user_ids) for shard, user_ids in parts.items())):
+        results.update(part)
+    return {user_id: results[user_id] for user_id in request.user_ids}
+
+
+@router_app.get("/popular")
+async def route_popular(request: Request):
+    """Популярное с любого шарда (шард выбирается по параметрам запроса).
+
+    Каждый шард видит равномерную выборку пользователей, поэтому рейтинги
+    популярности шардов почти совпадают.
+    """
+    router = get_router()
+    query = str(request.url.query)
+    return _proxy(await router.request(shard_of(query, router.shards), "GET", "/popular",
+                                       params=request.query_params))
+
+
+@router_app.get("/metrics", response_class=PlainTextResponse)
+async def get_router_metrics():
+    """Метрики маршрутизатора; метрики шардов отдают сами шарды."""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
@@ -1,15 +1,25 @@
 import asyncio
+import os
 import asyncpg
-from domain.use_cases import Recommender
+from domain.cache import RecommendationCache
+from domain.embeddings import build_embedding_index
+from domain.sharding import shard_mask, shard_of
+from domain.use_cases import Recommender, build_video_similarity
+from infrastructure.artifact import (CURRENT_FILE, capture_artifact_state, load_model_artifact,
+                                     prune_model_artifacts, save_model_artifact)
 from infrastructure.db import VideoRepository, InteractionRepository
-from infrastructure.rabbitmq import setup_rabbitmq
+from infrastructure.executor import PooledRecommenderExecutor, RecommenderExecutor
+from infrastructure.profiler import SamplingProfiler
+from infrastructure.rabbitmq import setup_catalog_queue, setup_rabbitmq
 from interfaces.api import app
-from interfaces.consumer import consume_interactions
+from interfaces.consumer import consume_catalog_events, consume_interactions, consume_interaction_batches
 import logging
 from uvicorn import Config, Server
 from config import host, user, password, db_name
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
+# Модули при импорте уже вызвали basicConfig, поэтому уровень задаётся напрямую
+logging.getLogger().setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
 async def init_db():
@@ -28,47 +38,264 @@ async def init_db():
         logger.error(f"Failed to initialize database: {e}")
         raise
 
+def embedding_options() -> dict:
+    """Параметры build_embedding_index из переменных окружения."""
+    return dict(
+        factors=int(os.getenv("EMBEDDING_FACTORS", "64")),
+        method=os.getenv("EMBEDDING_METHOD", "als"),
+        nlist=int(os.getenv("ANN_NLIST", "0")),
+        iterations=int(os.getenv("EMBEDDING_ITERATIONS", "10"))
+    )
+
+async def build_recommender(video_repo: VideoRepository, interaction_repo: InteractionRepository,
+                            executor: RecommenderExecutor, action_weights, cache, artifact_dir=None,
+                            **recommender_options) -> Recommender:
+    """Полное построение модели из БД; при artifact_dir результат экспортируется в артефакт."""
+    logger.info("Loading videos")
+    videos = await video_repo.get_all_videos()
+    if not videos:
+        logger.error("No videos found in database")
+        raise ValueError("Empty video list")
+
+    recommender = Recommender(
+        videos,
+        action_weights,
+        similarity_mode=os.getenv("SIMILARITY_MODE", "dense"),
+        top_k=int(os.getenv("SIMILARITY_TOP_K", "50")),
+        cache=cache,
+        **recommender_options
+    )
+
+    logger.info("Checking similarity matrix")
+    similarity_pairs = await video_repo.get_similarity_pairs()
+    if len(similarity_pairs[2]):
+        logger.info("Loading existing similarity matrix")
+        recommender.set_similarity_pairs(*similarity_pairs)
+    else:
+        logger.info("Computing new similarity matrix")
+        similarity = await executor.rebuild(
+            build_video_similarity, list(recommender.videos.values()), recommender.similarity_mode, recommender.top_k
+        )
+        recommender.install_similarity(similarity)
+        await video_repo.save_similarity_pairs(*recommender.similarity_pairs())
+
+    logger.info("Initializing user-item matrix")
+    watermark = await interaction_repo.get_interaction_watermark()
+    builder = recommender.matrix_builder()
+    async for chunk in interaction_repo.iter_interaction_chunks(max_id=watermark):
+        await executor.write(builder.add_chunk, chunk)
+    matrix = await executor.write(builder.build)
+    recommender.install_user_item_matrix(matrix)
+
+    if os.getenv("RETRIEVAL_MODE", "similarity") == "embedding":
+        logger.info("Training embeddings for candidate retrieval")
+        index = await executor.rebuild(build_embedding_index, matrix.to_csr(), **embedding_options())
+        recommender.install_embeddings(index)
+
+    if artifact_dir:
+        os.makedirs(artifact_dir, exist_ok=True)
+        save_model_artifact(recommender, artifact_dir, watermark)
+    return recommender
+
+async def sync_catalog(recommender: Recommender, video_repo: VideoRepository, executor: RecommenderExecutor):
+    """Применение изменений каталога, сделанных после экспорта артефакта модели."""
+    videos = await video_repo.get_all_videos()
+    current = {v.id: v for v in videos}
+    removed = [vid for vid in recommender.video_ids if vid not in current]
+    changed = [v for v in videos if v.id not in recommender.videos or recommender.videos[v.id].genres != v.genres]
+    if removed:
+        await executor.write(recommender.remove_videos, removed)
+    if changed:
+        await executor.write(recommender.upsert_videos, changed)
+    logger.info("Catalog synced with database: %d videos changed, %d removed", len(changed), len(removed))
+
+async def export_artifact(recommender: Recommender, interaction_repo: InteractionRepository,
+                          executor: RecommenderExecutor, artifact_dir: str, pause: asyncio.Lock):
+    """Экспорт текущей модели в новую версию артефакта с актуальным watermark.
+
+    На время чтения watermark и захвата состояния потребитель взаимодействий
+    приостанавливается (pause), поэтому все взаимодействия этого шарда с id
+    не больше watermark уже в модели, а с большим - ещё нет. Сама запись
+    (O(nnz)) выполняется в отдельном потоке и потребителя не задерживает.
+    """
+    async with pause:
+        watermark = await interaction_repo.get_interaction_watermark()
+        state = await executor.write(capture_artifact_state, recommender)
+    os.makedirs(artifact_dir, exist_ok=True)
+    await asyncio.to_thread(save_model_artifact, recommender, artifact_dir, watermark, state)
+    await asyncio.to_thread(prune_model_artifacts, artifact_dir, int(os.getenv("MODEL_ARTIFACT_KEEP", "2")))
+
+async def refresh_artifact(recommender: Recommender, interaction_repo: InteractionRepository,
+                           executor: RecommenderExecutor, artifact_dir: str, pause: asyncio.Lock,
+                           interval: float, export_now: bool):
+    """Периодический экспорт артефакта: при перезапуске дочитывается только хвост после последнего экспорта."""
+    while True:
+        if export_now:
+            try:
+                await export_artifact(recommender, interaction_repo, executor, artifact_dir, pause)
+            except Exception as e:
+                logger.error(f"Failed to export model artifact: {e}", exc_info=True)
+        if interval <= 0:
+            return
+        await asyncio.sleep(interval)
+        export_now = True
+
+async def retrain_embeddings(recommender: Recommender, executor: RecommenderExecutor, interval: float):
+    """Периодическое переобучение эмбеддингов по текущей матрице (в пуле перестроек).
+
+    Векторы получают видео, добавленные после прошлого обучения; модель
+    меняется одной публикацией снимка.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        if recommender.snapshot.embeddings is None:
+            continue
+        try:
+            snapshot = recommender.snapshot
+            csr = await executor.read(snapshot.user_matrix.to_csr)
+            index = await executor.rebuild(build_embedding_index, csr, **embedding_options())
+            if await executor.write(recommender.install_embeddings, index, snapshot.video_ids):
+                logger.info("Retrained embeddings for %d videos", index.n_items)
+        except Exception as e:
+            logger.error(f"Failed to retrain embeddings: {e}", exc_info=True)
+
+async def serve_router(port: int):
+    """Только маршрутизатор API: запросы уходят к процессам шардов из SHARD_URLS."""
+    from interfaces.router import ShardRouter, router_app
+
+    shard_urls = [url for url in os.getenv("SHARD_URLS", "").split(",") if url]
+    router_app.state.shard_router = ShardRouter(shard_urls)
+    logger.info("Routing API requests to %d shards", len(shard_urls))
+    try:
+        server = Server(Config(app=router_app, host="0.0.0.0", port=port, log_level="info"))
+        await server.serve()
+    finally:
+        await router_app.state.shard_router.close()
+
 async def main():
+    port = int(os.getenv("API_PORT", "8000"))
+    if os.getenv("ROLE", "worker") == "router":
+        await serve_router(port)
+        return
+    # Процесс-шард владеет пользователями с shard_of(user_id) == SHARD_INDEX:
+    # читает только их очередь и отвечает на их запросы (маршрутизатор - ROLE=router)
+    shards = int(os.getenv("SHARD_COUNT", "1"))
+    shard = int(os.getenv("SHARD_INDEX", "0"))
+    if not 0 <= shard < shards:
+        raise ValueError(f"SHARD_INDEX {shard} is out of range for SHARD_COUNT {shards}")
+    profiler = None
+    profiler_interval_ms = float(os.getenv("PROFILER_INTERVAL_MS", "0"))
+    if profiler_interval_ms > 0:
+        profiler = SamplingProfiler(interval=profiler_interval_ms / 1000)
+        profiler.start()
     try:
         pool = await init_db()
         video_repo = VideoRepository(pool)
         interaction_repo = InteractionRepository(pool)
 
-        logger.info("Loading videos")
-        videos = await video_repo.get_all_videos()
-        if not videos:
-            logger.error("No videos found in database")
-            raise ValueError("Empty video list")
+        if os.getenv("RECOMMENDER_EXECUTOR", "pool") == "pool":
+            executor = PooledRecommenderExecutor(read_workers=int(os.getenv("RECOMMENDER_READ_WORKERS", "4")))
+        else:
+            executor = RecommenderExecutor()
+        app.state.executor = executor
 
         action_weights = {"view": 1.0, "like": 2.0, "comment": 3.0, "favorite": 4.0}
-        recommender = Recommender(videos, action_weights)
-        
-        logger.info("Checking similarity matrix")
-        similarity_matrix = await video_repo.get_similarity_matrix()
-        if not similarity_matrix.empty:
-            logger.info("Loading existing similarity matrix")
-            recommender.video_similarity = similarity_matrix
-        else:
-            logger.info("Computing new similarity matrix")
-            recommender.compute_video_similarity()
-            await video_repo.save_similarity_matrix(recommender.video_similarity)
+        cache_size = int(os.getenv("RECOMMENDATION_CACHE_SIZE", "10000"))
+        cache = RecommendationCache(
+            max_entries=cache_size,
+            ttl_seconds=float(os.getenv("RECOMMENDATION_CACHE_TTL", "300"))
+        ) if cache_size > 0 else None
+        recommender_options = dict(
+            popularity_half_life=float(os.getenv("POPULARITY_HALF_LIFE_HOURS", "24")) * 3600,
+            cold_start_min_items=int(os.getenv("COLD_START_MIN_ITEMS", "1")),
+            rerank_weight=float(os.getenv("RERANK_WEIGHT", "0.3")),
+            rerank_depth=int(os.getenv("RERANK_DEPTH", "10")),
+            # Ручка полнота/задержка поиска по эмбеддингам: число просматриваемых ячеек IVF
+            ann_nprobe=int(os.getenv("ANN_NPROBE", "0")) or None
+        )
 
-        logger.info("Initializing user-item matrix")
-        interactions = await interaction_repo.get_all_interactions()
-        recommender.update_user_item_matrix(interactions)
+        artifact_dir = os.getenv("MODEL_ARTIFACT_DIR")
+        # Шарды экспортируют свои модели в подкаталоги; общий артефакт - от полной сборки нулевым шардом
+        shard_artifact_dir = artifact_dir
+        if artifact_dir and shards > 1:
+            shard_artifact_dir = os.path.join(artifact_dir, f"shard-{shard}")
+        load_dir = next((d for d in (shard_artifact_dir, artifact_dir)
+                         if d and os.path.exists(os.path.join(d, CURRENT_FILE))), None)
+        export_now = False
+        if load_dir:
+            logger.info("Loading model artifact from %s", load_dir)
+            recommender, watermark = load_model_artifact(load_dir, action_weights, cache=cache,
+                                                         **recommender_options)
+            # Режимы модели берутся из артефакта: SIMILARITY_MODE и RETRIEVAL_MODE действуют только
+            # при полной сборке (для смены режима удалите MODEL_ARTIFACT_DIR)
+            if recommender.similarity_mode != os.getenv("SIMILARITY_MODE", "dense"):
+                logger.warning("SIMILARITY_MODE is ignored: model artifact uses %s similarity",
+                               recommender.similarity_mode)
+            has_embeddings = recommender.snapshot.embeddings is not None
+            if has_embeddings != (os.getenv("RETRIEVAL_MODE", "similarity") == "embedding"):
+                logger.warning("RETRIEVAL_MODE is ignored: model artifact %s embeddings",
+                               "has" if has_embeddings else "has no")
+            await sync_catalog(recommender, video_repo, executor)
+            delta, watermark = await interaction_repo.get_interactions_since(watermark)
+            if shards > 1:
+                await executor.write(recommender.retain_users, lambda user_id: shard_of(user_id, shards) == shard)
+                delta = delta.take(shard_mask(delta.user_ids, shard, shards))
+            await executor.write(recommender.apply_interactions, delta)
+            # Дочитанный хвост сразу фиксируется в новом артефакте, чтобы он не рос между перезапусками
+            export_now = len(delta) > 0 or load_dir != shard_artifact_dir
+        else:
+            # Артефакт пишет только нулевой шард, остальные подхватят его при следующем запуске
+            recommender = await build_recommender(video_repo, interaction_repo, executor, action_weights, cache,
+                                                  artifact_dir if shard == 0 else None, **recommender_options)
+            if shards > 1:
+                await executor.write(recommender.retain_users, lambda user_id: shard_of(user_id, shards) == shard)
 
         app.state.recommender = recommender
         app.state.interaction_repo = interaction_repo
         app.state.db_pool = pool
 
         logger.info("Setting up RabbitMQ")
-        connection, channel, queue = await setup_rabbitmq()
+        batch_size = int(os.getenv("CONSUMER_BATCH_SIZE", "1"))
+        linger_ms = float(os.getenv("CONSUMER_LINGER_MS", "50"))
+        prefetch_count = int(os.getenv("RABBITMQ_PREFETCH", str(batch_size)))
+        if prefetch_count < batch_size:
+            logger.warning("RABBITMQ_PREFETCH (%d) is lower than CONSUMER_BATCH_SIZE (%d); batches will not fill",
+                           prefetch_count, batch_size)
+        connection, _, queue = await setup_rabbitmq(prefetch_count=prefetch_count, shard=shard, shards=shards)
         app.state.rabbitmq_connection = connection
-        consumer_task = asyncio.create_task(consume_interactions(queue, recommender, interaction_repo))
+        pause = asyncio.Lock()
+        if batch_size > 1:
+            consumer = consume_interaction_batches(queue, recommender, interaction_repo, batch_size, linger_ms,
+                                                   executor=executor, pause=pause)
+        else:
+            consumer = consume_interactions(queue, recommender, interaction_repo, executor=executor, pause=pause)
+        consumer_task = asyncio.create_task(consumer)
         logger.info("Consumer task started")
 
+        retrain_interval = float(os.getenv("EMBEDDING_RETRAIN_INTERVAL", "86400"))
+        if retrain_interval > 0:
+            retrain_task = asyncio.create_task(retrain_embeddings(recommender, executor, retrain_interval))
+
+        if artifact_dir:
+            artifact_task = asyncio.create_task(refresh_artifact(
+                recommender, interaction_repo, executor, shard_artifact_dir, pause,
+                interval=float(os.getenv("MODEL_ARTIFACT_INTERVAL", "3600")), export_now=export_now
+            ))
+
+        catalog_queue_name = os.getenv("CATALOG_QUEUE", "video_catalog_queue")
+        if catalog_queue_name:
+            catalog_batch_size = int(os.getenv("CATALOG_BATCH_SIZE", "100"))
+            catalog_queue = await setup_catalog_queue(connection, catalog_queue_name, shard if shards > 1 else None,
+                                                      prefetch_count=catalog_batch_size)
+            catalog_task = asyncio.create_task(
+                # Таблицы каталога и схожести в БД общие: их обновляет только нулевой шард (как и артефакт)
+                consume_catalog_events(catalog_queue, recommender, video_repo, executor=executor,
+                                       batch_size=catalog_batch_size, persist=shard == 0)
+            )
+            logger.info("Catalog consumer task started")
+
         # Run Uvicorn server in the same event loop
-        config = Config(app=app, host="0.0.0.0", port=8000, log_level="info")
+        config = Config(app=app, host="0.0.0.0", port=port, log_level="info")
         server = Server(config)
         await server.serve()
 
@@ -81,12 +308,20 @@ async def main():
             await app.state.rabbitmq_connection.close()
         if hasattr(app.state, "db_pool"):
             await app.state.db_pool.close()
-        if "consumer_task" in locals():
-            consumer_task.cancel()
+        for task_name in ("consumer_task", "catalog_task", "artifact_task", "retrain_task"):
+            task = locals().get(task_name)
+            if task is None:
+                continue
+            task.cancel()
             try:
-                await consumer_task
+                await task
             except asyncio.CancelledError:
                 pass
+        if hasattr(app.state, "executor"):
+            app.state.executor.shutdown()
+        if profiler is not None:
+            profiler.stop()
+            profiler.write(os.getenv("PROFILER_OUTPUT", "profile.collapsed"))
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,92 @@
+import asyncio
+import json
+from benchmarks.in_memory import InMemoryBroker, InMemoryInteractionRepository
+from domain.entities import Video
+from domain.use_cases import Recommender
+from interfaces.consumer import _BatchCollector, consume_catalog_events, consume_interaction_batches
+
+VIDEOS = [Video(id=f"v{i}", genres=[f"g{i % 3}"]) for i in range(10)]
+LINGER_MS = 10
+
+
+async def _wait_for(condition, timeout: float = 5.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            raise AssertionError("condition not reached")
+        await asyncio.sleep(0.005)
+
+
+async def _stop(task: asyncio.Task):
+    """Потребители переживают одну отмену (переподключение), поэтому отмена повторяется."""
+    while not task.done():
+        task.cancel()
+        await asyncio.wait({task}, timeout=0.1)
+
+
+async def _publish_in_partial_batches(broker: InMemoryBroker, bodies):
+    """Каждое сообщение - отдельная неполная пачка: таймер linger истекает на каждой."""
+    for count, body in enumerate(bodies, 1):
+        await broker.publish_body(body)
+        await _wait_for(lambda: broker.acked + broker.rejected >= count)
+        await asyncio.sleep(2 * LINGER_MS / 1000)
+
+
+def test_batch_collector_keeps_iterator_open_across_linger_timeouts():
+    async def run():
+        broker = InMemoryBroker(prefetch_count=10)
+        async with broker.iterator() as messages:
+            batches = _BatchCollector(messages)
+            for i in range(3):
+                await broker.publish_body(str(i).encode())
+                batch = await batches.collect(batch_size=10, linger_ms=LINGER_MS)
+                assert [m.body for m in batch] == [str(i).encode()]
+                await batch[-1].ack()
+            assert broker.consumers == 1
+            await batches.close()
+        assert broker.consumers == 0
+        assert broker.acked == 3
+
+    asyncio.run(run())
+
+
+def test_interaction_batches_survive_repeated_linger_timeouts():
+    async def run():
+        broker = InMemoryBroker(prefetch_count=10)
+        repo = InMemoryInteractionRepository()
+        recommender = Recommender(VIDEOS, {"view": 1.0})
+        consumer = asyncio.create_task(consume_interaction_batches(broker, recommender, repo, batch_size=10,
+                                                                   linger_ms=LINGER_MS))
+        try:
+            await _publish_in_partial_batches(broker, [
+                json.dumps({"user_id": f"u{i}", "video_id": f"v{i}", "action": "view"}).encode() for i in range(4)
+            ])
+            assert broker.acked == 4
+            assert broker.consumers == 1
+            assert [i.user_id for i in repo.interactions] == ["u0", "u1", "u2", "u3"]
+        finally:
+            await _stop(consumer)
+
+    asyncio.run(run())
+
+
+def test_catalog_events_survive_repeated_linger_timeouts():
+    async def run():
+        broker = InMemoryBroker(prefetch_count=10)
+        recommender = Recommender(VIDEOS, {"view": 1.0})
+        recommender.compute_video_similarity()
+        consumer = asyncio.create_task(consume_catalog_events(broker, recommender, video_repo=None, batch_size=10,
+                                                              linger_ms=LINGER_MS, persist=False))
+        try:
+            bodies = [json.dumps({"op": "upsert", "id": f"new{i}", "genres": ["g0"]}).encode() for i in range(3)]
+            bodies.append(json.dumps({"op": "delete", "id": "v0"}).encode())
+            await _publish_in_partial_batches(broker, bodies)
+            assert broker.acked == 4
+            assert broker.consumers == 1
+            assert {"new0", "new1", "new2"} <= set(recommender.video_ids)
+            assert "v0" not in recommender.video_ids
+        finally:
+            await _stop(consumer)
+
+    asyncio.run(run())
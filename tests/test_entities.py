@@ -0,0 +1,44 @@
+import asyncio
+import contextlib
+import numpy as np
+from domain.entities import UNKNOWN_ACTION, Interaction, InteractionBatch
+from infrastructure.db import InteractionRepository
+
+
+class _RecordingConnection:
+    def __init__(self):
+        self.records = []
+
+    async def executemany(self, query, records):
+        self.records.extend(records)
+
+
+class _RecordingPool:
+    def __init__(self):
+        self.connection = _RecordingConnection()
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield self.connection
+
+
+def test_unknown_action_survives_batch_round_trip():
+    batch = InteractionBatch.from_columns(["u1", "u2", "u3"], ["v1", "v2", "v3"], ["share", "like", "rewatch"])
+    assert batch.action_codes.tolist() == [UNKNOWN_ACTION, 1, UNKNOWN_ACTION]
+    assert batch.actions == ["share", "like", "rewatch"]
+    assert [i.action for i in batch] == ["share", "like", "rewatch"]
+    assert InteractionBatch.from_interactions(batch).actions == ["share", "like", "rewatch"]
+
+
+def test_take_keeps_unknown_actions_aligned():
+    batch = InteractionBatch.from_columns(["u1", "u2", "u3"], ["v1", "v2", "v3"], ["view", "share", "rewatch"])
+    assert batch.take(np.array([False, True, True])).actions == ["share", "rewatch"]
+    assert batch.take(np.array([True, False, True])).actions == ["view", "rewatch"]
+    assert batch.take(np.array([True, False, False])).unknown_actions == {}
+
+
+def test_save_interactions_persists_unknown_action():
+    pool = _RecordingPool()
+    batch = InteractionBatch.from_interactions([Interaction("u1", "v1", "share"), Interaction("u2", "v2", "view")])
+    asyncio.run(InteractionRepository(pool).save_interactions(batch))
+    assert list(pool.connection.records) == [("u1", "v1", "share"), ("u2", "v2", "view")]
@@ -0,0 +1,29 @@
+import pytest
+from domain.metrics import Counter, Histogram, MetricsRegistry, _Metric
+
+
+def test_incomplete_metric_subclass_fails_at_creation():
+    class Incomplete(_Metric):
+        kind = "gauge"
+
+        def _new_child(self):
+            return object()
+
+    with pytest.raises(TypeError):
+        Incomplete("incomplete", "Missing _samples")
+    with pytest.raises(TypeError):
+        _Metric("base", "Abstract base")
+
+
+def test_registry_renders_counter_and_histogram():
+    registry = MetricsRegistry()
+    counter = registry.counter("events_total", "Events", ["outcome"])
+    histogram = registry.histogram("work_seconds", "Work", buckets=(0.1, 1.0))
+    counter.labels("ack").inc(2)
+    histogram.observe(0.5)
+    assert isinstance(counter, Counter) and isinstance(histogram, Histogram)
+    text = registry.render()
+    assert 'events_total{outcome="ack"} 2' in text
+    assert 'work_seconds_bucket{le="0.1"} 0' in text
+    assert 'work_seconds_bucket{le="+Inf"} 1' in text
+    assert "work_seconds_count 1" in text
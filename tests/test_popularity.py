@@ -0,0 +1,38 @@
+import numpy as np
+from domain.popularity import PopularityIndex
+
+VIDEO_IDS = [f"v{i}" for i in range(20)]
+GENRES = [["even" if i % 2 == 0 else "odd"] for i in range(20)]
+
+
+def _index(max_ranked: int = 5) -> PopularityIndex:
+    index = PopularityIndex(VIDEO_IDS, GENRES, max_ranked=max_ranked, clock=lambda: 0.0)
+    # v19 самое популярное, v0 - наименее
+    index.seed(np.arange(1, 21, dtype=np.float64))
+    return index
+
+
+def test_top_falls_back_to_catalog_when_exclude_covers_ranked_prefix():
+    index = _index(max_ranked=5)
+    seen = {f"v{i}" for i in range(13, 20)}
+    assert len(seen) >= index.max_ranked
+    top = index.top(3, exclude=seen)
+    assert [video_id for video_id, _ in top] == ["v12", "v11", "v10"]
+    assert [score for _, score in top] == [13 / 20, 12 / 20, 11 / 20]
+
+
+def test_genre_top_falls_back_to_catalog():
+    index = _index(max_ranked=2)
+    top = index.top(2, genre="even", exclude={"v18", "v16", "v14"})
+    assert [video_id for video_id, _ in top] == ["v12", "v10"]
+
+
+def test_top_uses_ranked_prefix_when_it_suffices():
+    index = _index(max_ranked=5)
+    assert [video_id for video_id, _ in index.top(2, exclude={"v19"})] == ["v18", "v17"]
+    assert index.top(0, exclude={"v19"}) == []
+
+
+def test_top_is_empty_when_everything_is_excluded():
+    index = _index(max_ranked=5)
+    assert index.top(3, exclude=set(VIDEO_IDS)) == []
@@ -0,0 +1,138 @@
+import random
+import time
+import numpy as np
+from domain.entities import Interaction, Video
+from domain.use_cases import Recommender
+from domain.user_item_matrix import UserItemMatrix
+
+ITEM_IDS = [f"v{i}" for i in range(30)]
+
+
+def _base_matrix(n_users: int = 20, seed: int = 0) -> UserItemMatrix:
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(n_users, size=200)
+    cols = rng.integers(len(ITEM_IDS), size=200)
+    return UserItemMatrix.from_coo(ITEM_IDS, [f"u{i}" for i in range(n_users)], rows, cols, np.ones(200),
+                                   compact_threshold=1000)
+
+
+def _dense(matrix: UserItemMatrix) -> dict:
+    return {user_id: matrix.dense_row(user_id) for user_id in matrix.user_ids}
+
+
+def _assert_same(actual: dict, expected: dict):
+    assert set(actual) == set(expected)
+    for user_id, row in expected.items():
+        np.testing.assert_allclose(actual[user_id], row, err_msg=user_id)
+
+
+def _random_writes(matrix: UserItemMatrix, rng: random.Random, count: int):
+    """Случайные записи, в том числе новых пользователей u20..u29."""
+    for _ in range(count):
+        user_id = f"u{rng.randrange(30)}"
+        if rng.random() < 0.5:
+            matrix = matrix.with_value(user_id, rng.choice(ITEM_IDS), 1.0)
+        else:
+            cols = np.array([matrix.item_index[rng.choice(ITEM_IDS)] for _ in range(3)])
+            matrix = matrix.with_batch([user_id] * 3, cols, np.full(3, 0.5))
+    return matrix
+
+
+def test_old_version_is_unchanged_by_later_writes():
+    rng = random.Random(0)
+    v0 = _base_matrix()
+    v1 = _random_writes(v0, rng, 20)
+    expected_v0, expected_v1 = _dense(v0), _dense(v1)
+    nnz_v0, nnz_v1 = v0.nnz, v1.nnz
+
+    v2 = _random_writes(v1, rng, 200)
+    _random_writes(v2.compact(), rng, 50)
+
+    _assert_same(_dense(v0), expected_v0)
+    _assert_same(_dense(v1), expected_v1)
+    assert (v0.nnz, v1.nnz) == (nnz_v0, nnz_v1)
+    assert len(v0) == 20
+    np.testing.assert_allclose(v1.to_csr().toarray(), np.array([expected_v1[u] for u in v1.user_ids]))
+
+
+def test_stale_branch_does_not_see_newer_overlay_entries():
+    v0 = _base_matrix()
+    v1 = v0.with_value("u1", "v1", 1.0)
+    v2 = v1.with_value("u1", "v2", 1.0).with_value("u2", "v3", 1.0)
+    expected_v2 = _dense(v2)
+
+    # v1 устарела: после неё писатель уже выпустил v2
+    branch = v1.with_value("u3", "v4", 1.0)
+    np.testing.assert_allclose(branch.dense_row("u1"), v1.dense_row("u1"))
+    np.testing.assert_allclose(branch.dense_row("u2"), v1.dense_row("u2"))
+    assert branch.dense_row("u3")[4] == v1.dense_row("u3")[4] + 1.0
+    branch = branch.with_value("u1", "v5", 2.0)
+    assert branch.dense_row("u1")[2] == v1.dense_row("u1")[2]
+
+    # Записи ветки не попадают в основную линию
+    _assert_same(_dense(v2), expected_v2)
+    v3 = v2.with_value("u4", "v6", 1.0)
+    np.testing.assert_allclose(v3.dense_row("u3"), v2.dense_row("u3"))
+    np.testing.assert_allclose(v3.dense_row("u1"), expected_v2["u1"])
+
+
+def test_rebase_after_compact_matches_full_rebuild():
+    rng = random.Random(1)
+    source = _random_writes(_base_matrix(), rng, 100)
+    compacted = source.compact()
+    current = _random_writes(source, rng, 100)
+
+    rebased = current.rebase(source, compacted)
+    assert rebased is not current
+    assert rebased._base is compacted._base
+    _assert_same(_dense(rebased), _dense(current))
+    rebuilt = UserItemMatrix.from_csr(ITEM_IDS, current.user_ids, current.to_csr())
+    _assert_same(_dense(rebased), _dense(rebuilt))
+    np.testing.assert_allclose(rebased.to_csr().toarray(), rebuilt.to_csr().toarray())
+
+    # Перебазированная версия остаётся рабочей основой для следующих записей
+    after = _random_writes(rebased, rng, 50)
+    _assert_same(_dense(after.compact()), _dense(after))
+
+
+def test_rebase_ignores_unrelated_source():
+    rng = random.Random(2)
+    source = _random_writes(_base_matrix(), rng, 10)
+    other = _random_writes(_base_matrix(), rng, 10)
+    assert other.rebase(source, source.compact()) is other
+
+
+class _CountingRecommender(Recommender):
+    compactions = 0
+
+    def _compact(self, matrix):
+        # Замедление расширяет окно, в котором писатель работает параллельно слиянию
+        time.sleep(0.002)
+        super()._compact(matrix)
+        self.compactions += 1
+
+
+def test_background_compaction_loses_no_concurrent_interactions():
+    rng = random.Random(3)
+    videos = [Video(id=video_id, genres=["g"]) for video_id in ITEM_IDS]
+    weights = {"view": 1.0, "like": 2.0}
+    recommender = _CountingRecommender(videos, weights)
+    warm = [Interaction(f"u{rng.randrange(50)}", rng.choice(ITEM_IDS), "view") for _ in range(500)]
+    recommender.update_user_item_matrix(warm)
+    recommender.user_item_matrix.compact_threshold = 5
+
+    events = [Interaction(f"u{rng.randrange(80)}", rng.choice(ITEM_IDS), rng.choice(["view", "like"]))
+              for _ in range(3000)]
+
+    # Писатель - этот поток, слияния идут в фоновых потоках рекомендателя
+    for i in range(0, len(events), 10):
+        recommender.apply_interaction(events[i])
+        recommender.apply_interactions(events[i + 1:i + 10])
+    deadline = time.monotonic() + 10
+    while recommender._compacting and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert recommender.compactions > 1
+    expected = UserItemMatrix.from_interactions(ITEM_IDS, warm + events, recommender._score)
+    _assert_same(_dense(recommender.user_item_matrix), _dense(expected))
+    np.testing.assert_allclose(recommender.user_item_matrix.column_sums(), expected.column_sums())